@@ -0,0 +1,164 @@
+# Example usage:
+#
+# python bench_asyncio.py
+# python bench_asyncio.py --connections 10000 --requests 5
+# python bench_asyncio.py --modes asyncio --connections 20000
+#
+# Starts better-webserver.py once per --modes entry, each allowed
+# --connections concurrent connections, and opens that many keep-alive
+# connections to it at once.  Every connection sends --requests GETs for
+# --path one after another, then stays open until all of them have finished,
+# so the server holds every connection at the same time.  Reports requests
+# per second, failed connections, and the server's resident memory while
+# all connections are open, plus its peak.  The blocking server needs a
+# thread per connection; the asyncio one should stay close to flat.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, "better-webserver.py")
+# Connections that may be between connecting and their first response at
+# once.  Opening thousands in one burst starves this process's own loop, and
+# the server drops a connection whose first request takes over two seconds.
+CONNECT_BATCH = 256
+
+
+def server_memory_kib(pid: int) -> tuple[int, int]:
+    """Returns the server's current and peak resident memory."""
+    rss = peak = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, peak
+
+
+def start_server(port: int, mode: str, connections: int) -> subprocess.Popen:
+    args = [sys.executable, SERVER, str(port), "--max-connections", str(connections),
+            "--keep-alive-timeout", "60"]
+    if mode == "asyncio":
+        args.append("--asyncio")
+    proc = subprocess.Popen(args, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("better-webserver did not start")
+
+
+async def get(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, request: bytes) -> bool:
+    writer.write(request)
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return head.startswith(b"HTTP/1.1 200")
+
+
+async def client(port: int, path: str, requests: int,
+                 connecting: asyncio.Semaphore) -> tuple[asyncio.StreamWriter, int]:
+    """
+    Sends `requests` GETs on one connection and returns the connection, left
+    open, and how many got a 200.
+    """
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("ISO-8859-1")
+    async with connecting:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            ok = int(await get(reader, writer, request))
+        except BaseException:
+            writer.close()
+            raise
+
+    try:
+        for _ in range(requests - 1):
+            ok += await get(reader, writer, request)
+    except BaseException:
+        writer.close()
+        raise
+    return writer, ok
+
+
+async def run(port: int, pid: int, args: argparse.Namespace) -> tuple[float, int, int, int]:
+    """
+    Returns the elapsed seconds, the successful requests, the failed
+    connections and the server's resident memory with the rest still open.
+    """
+    connecting = asyncio.Semaphore(CONNECT_BATCH)
+    start = time.perf_counter()
+    clients = [asyncio.create_task(client(port, args.path, args.requests, connecting))
+               for _ in range(args.connections)]
+
+    finished, pending = await asyncio.wait(clients, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    rss, _ = server_memory_kib(pid)
+
+    for task in pending:
+        task.cancel()
+    await asyncio.wait(clients)
+
+    ok = failed = 0
+    for task in clients:
+        if task.cancelled() or task.exception() is not None:
+            failed += 1
+            continue
+        writer, count = task.result()
+        ok += count
+        writer.close()
+    return elapsed, ok, failed, rss
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bench_asyncio.py")
+    parser.add_argument("--port", type=int, default=33290)
+    parser.add_argument("--modes", nargs="+", choices=["blocking", "asyncio"], default=["blocking", "asyncio"])
+    parser.add_argument("--connections", type=int, default=2000, help="concurrent keep-alive connections")
+    parser.add_argument("--requests", type=int, default=5, help="requests per connection, at least 1")
+    parser.add_argument("--path", default="/index.html")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="seconds before unfinished connections count as failed")
+    args = parser.parse_args(argv[1:])
+    args.requests = max(1, args.requests)
+
+    # Both ends need a descriptor per connection.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.connections + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+
+    print(f"{'mode':>8} {'conns':>6} {'req/s':>9} {'failed':>7} {'RSS KiB':>9} {'peak RSS KiB':>13}")
+    for index, mode in enumerate(args.modes):
+        port = args.port + index
+        proc = start_server(port, mode, args.connections)
+        try:
+            elapsed, ok, failed, rss = asyncio.run(run(port, proc.pid, args))
+            _, peak = server_memory_kib(proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f"{mode:>8} {args.connections:6} {ok / elapsed:9.0f} {failed:7} {rss:9} {peak:13}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,82 @@
+# Example usage:
+#
+# python bench_gzip.py
+# python bench_gzip.py --requests 2000 --files file1.txt index.html
+#
+# Starts better-webserver.py on the sample files in this directory and, over
+# one keep-alive connection, requests each file --requests times without and
+# then with "Accept-Encoding: gzip".  Reports the body bytes on the wire and
+# the mean request latency for both.  The first gzip request compresses the
+# file; the rest are served from the gzip variant cache.  Tiny files such as
+# file1.txt and images such as marbles.jpg are expected to go out unencoded.
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import http.client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, "better-webserver.py")
+
+
+def start_server(port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, SERVER, str(port)], cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("better-webserver did not start")
+
+
+def measure(conn: http.client.HTTPConnection, path: str, headers: dict[str, str],
+            requests: int) -> tuple[int, str, float]:
+    """Returns body bytes, Content-Encoding and mean latency in microseconds."""
+    nbytes = 0
+    encoding = ""
+    start = time.perf_counter()
+    for _ in range(requests):
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f"{path}: HTTP {resp.status}")
+        nbytes = len(body)
+        encoding = resp.getheader("Content-Encoding", "identity")
+    return nbytes, encoding, (time.perf_counter() - start) / requests * 1e6
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bench_gzip.py")
+    parser.add_argument("--port", type=int, default=33191)
+    parser.add_argument("--requests", type=int, default=500, help="requests per file and encoding")
+    parser.add_argument("--files", nargs="+", default=["file1.txt", "file2.html", "index.html", "marbles.jpg"])
+    args = parser.parse_args(argv[1:])
+
+    proc = start_server(args.port)
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", args.port)
+        print(f"{'file':>12} {'identity B':>10} {'us':>8} {'gzip B':>8} {'encoding':>9} {'us':>8} {'saved':>6}")
+        for name in args.files:
+            path = "/" + name
+            plain, _, plain_us = measure(conn, path, {}, args.requests)
+            packed, encoding, packed_us = measure(conn, path, {"Accept-Encoding": "gzip"}, args.requests)
+            print(f"{name:>12} {plain:10} {plain_us:8.1f} {packed:8} {encoding:>9} {packed_us:8.1f}"
+                  f" {1 - packed / plain:6.1%}")
+        conn.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
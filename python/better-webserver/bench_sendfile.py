@@ -0,0 +1,104 @@
+# Example usage:
+#
+# python bench_sendfile.py
+# python bench_sendfile.py --sizes 1 16 256 --requests 10
+# python bench_sendfile.py --clients 32
+#
+# Starts better-webserver.py in a scratch directory holding one file per
+# --sizes entry (in MiB), has --clients concurrent clients download each file
+# --requests times, and reports aggregate throughput and the server's peak
+# resident memory after each size.  With the body sent by sendfile(2) the
+# peak should stay flat as files grow; a server that reads the file into
+# memory grows by about twice the file size per concurrent download.
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, "better-webserver.py")
+
+
+def server_peak_kib(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def start_server(port: int, root: str) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, SERVER, str(port)], cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("better-webserver did not start")
+
+
+def download(port: int, path: str, buf: bytearray) -> int:
+    """Fetches `path` and returns the number of bytes received, headers included."""
+    with socket.create_connection(("127.0.0.1", port), timeout=60) as s:
+        s.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode("ISO-8859-1"))
+        total = 0
+        while True:
+            n = s.recv_into(buf)
+            if n == 0:
+                return total
+            total += n
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bench_sendfile.py")
+    parser.add_argument("--port", type=int, default=33190)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 8, 64], help="file sizes in MiB")
+    parser.add_argument("--requests", type=int, default=5, help="downloads per file and client")
+    parser.add_argument("--clients", type=int, default=1, help="concurrent downloads")
+    args = parser.parse_args(argv[1:])
+
+    with tempfile.TemporaryDirectory() as root:
+        for size in args.sizes:
+            with open(os.path.join(root, f"{size}mib.txt"), "wb") as f:
+                f.write(os.urandom(1024 * 1024) * size)
+
+        def client(size: int):
+            buf = bytearray(256 * 1024)
+            for _ in range(args.requests):
+                received = download(args.port, f"/{size}mib.txt", buf)
+                if received < size * 1024 * 1024:
+                    raise RuntimeError(f"short response for {size} MiB: {received} bytes")
+
+        proc = start_server(args.port, root)
+        try:
+            print(f"{'size MiB':>8} {'MiB/s':>9} {'ms/request':>11} {'server peak RSS KiB':>20}")
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                for size in args.sizes:
+                    start = time.perf_counter()
+                    for result in [pool.submit(client, size) for _ in range(args.clients)]:
+                        result.result()
+                    elapsed = time.perf_counter() - start
+                    total = args.requests * args.clients
+                    print(f"{size:8} {size * total / elapsed:9.1f} {elapsed / args.requests * 1000:11.2f}"
+                          f" {server_peak_kib(proc.pid):20}")
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
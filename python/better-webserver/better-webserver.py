@@ -1,18 +1,81 @@
 import os
 import sys
+import time
+import signal
 import socket
+import gzip
+import asyncio
+import resource
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, BinaryIO
+
+from file_cache import FileCache, CacheEntry
+
+# The request parser is shared with ../webserver.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "webserver"))
+from http_parser import Request, RequestParser, HttpParseError, error_response
 
 Addr = Union[tuple[str, int], tuple[str, int, int, int]]
 
 CRLF = "\r\n"
 ENCODING = "ISO-8859-1"
 DEFAULT_PORT = 33090
-RECV_CHUNK = 4096
-HEADER_END = b"\r\n\r\n"
+RECV_CHUNK = 64 * 1024
+# This server only answers GET, so a request body is read and dropped;
+# anything larger is refused.
+MAX_REQUEST_BODY = 64 * 1024
+# With --asyncio, responses go out this much at a time, each piece within
+# REQUEST_TIMEOUT.  Like the socket timeout in the thread pool, that drops a
+# client that stops reading without limiting how long a slow download takes.
+ASYNC_SEND_CHUNK = 256 * 1024
+# Lets the headers go out in the same segment as the start of the body.
+SEND_MORE = getattr(socket, "MSG_MORE", 0)
 UNSAFE_MODE = False
 ROOT_DIR = os.getcwd()
+# Connections served at once, one pool thread each.  Further clients wait in
+# the listen backlog until a slot frees up.
+DEFAULT_MAX_CONNECTIONS = 128
+# With --asyncio a connection costs a task and a socket rather than a thread,
+# so the cap is set by file descriptors instead.
+DEFAULT_ASYNC_MAX_CONNECTIONS = 16 * 1024
+LISTEN_BACKLOG = 1024
+# Seconds to let in-flight requests finish on shutdown before cutting them off.
+DEFAULT_DRAIN_TIMEOUT = 10.0
+# A request must arrive in full within REQUEST_TIMEOUT seconds of its first
+# byte (or of the connection opening); between requests a persistent
+# connection may sit idle for KEEPALIVE_TIMEOUT.  After MAX_REQUESTS
+# responses the connection is closed.
+REQUEST_TIMEOUT = 2.0
+KEEPALIVE_TIMEOUT = 5.0
+MAX_REQUESTS = 100
+# Byte budget of the file cache (0 disables it), and the largest file whose
+# body it keeps.
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+DEFAULT_CACHE_MAX_FILE = 256 * 1024
+FILE_CACHE = FileCache(DEFAULT_CACHE_BYTES, DEFAULT_CACHE_MAX_FILE)
+# Gzipped variants of compressible files, from a sibling .gz file if there
+# is one and compressed on the fly otherwise.  Keyed by the mtime and size of
+# the source file and of its .gz sibling, so an edit to either starts a new
+# entry and the old one ages out.  Files larger than GZIP_MAX_FILE without a .gz sibling
+# are sent uncompressed rather than compressed per request.
+DEFAULT_GZIP_CACHE_BYTES = 8 * 1024 * 1024
+GZIP_MAX_FILE = 1024 * 1024
+GZIP_LEVEL = 6
+GZIP_CACHE = FileCache(DEFAULT_GZIP_CACHE_BYTES, DEFAULT_CACHE_MAX_FILE)
+
+# Sockets being served by the pool, and those of them waiting for their next
+# request, which a drain can close straight away.  Guarded by active_cond.
+active: set[socket.socket] = set()
+idle: set[socket.socket] = set()
+active_cond = threading.Condition()
+draining = False
+# With --asyncio, the task serving each connection.  The event loop is the
+# only thread, so `active` and `idle` need no lock then.
+tasks: set[asyncio.Task] = set()
 
 RESPONSE_404 = (
     "HTTP/1.1 404 Not Found\r\n"
@@ -23,6 +86,17 @@ RESPONSE_404 = (
     "404 not found"
 ).encode(ENCODING)
 
+RESPONSE_404_KEEP_ALIVE = RESPONSE_404.replace(b"Connection: close", b"Connection: keep-alive")
+
+# Completes a cached header block.
+END_KEEP_ALIVE = b"Connection: keep-alive\r\n\r\n"
+END_CLOSE = b"Connection: close\r\n\r\n"
+
+# A Range header asking for more parts than this is ignored and the whole
+# file sent instead, so one request cannot ask for thousands of tiny parts.
+MAX_RANGES = 16
+MULTIPART_BOUNDARY = "better-webserver-byteranges"
+
 EXT_TO_CONTENT_TYPE: dict[str, str] = {
     ".txt" : "text/plain",
     ".html": "text/html",
@@ -30,11 +104,15 @@ EXT_TO_CONTENT_TYPE: dict[str, str] = {
     ".jpg" : "image/jpeg",
 }
 
+# Worth gzipping; images are compressed already.
+COMPRESSIBLE_TYPES: set[str] = {"text/plain", "text/html"}
+
 @dataclass
-class HttpRequest:
-    method: str
-    path: str
-    protocol: str
+class Response:
+    # Sent in order: bytes as they are, and (offset, count) spans of the
+    # file at `path` with sendfile(2).
+    parts: list[Union[bytes, tuple[int, int]]]
+    path: Optional[str] = None
 
 def _resolve_path_safe(url_path: str, root: str) -> Optional[str]:
     abs_root = os.path.abspath(root)
@@ -57,126 +135,707 @@ def sanitize_path(url_path: str) -> Optional[str]:
     else:
         return _resolve_path_safe(url_path, ROOT_DIR)
 
-def make_response(status_line: str, headers: dict[str, str], body: bytes) -> bytes:
+def make_header_lines(status_line: str, headers: dict[str, str]) -> bytes:
     head = status_line + CRLF
 
     for key, val in headers.items():
         head += f"{key}: {val}{CRLF}"
 
-    head += CRLF
-    return head.encode(ENCODING) + body
+    return head.encode(ENCODING)
+
+def make_header(status_line: str, headers: dict[str, str]) -> bytes:
+    return make_header_lines(status_line, headers) + CRLF.encode(ENCODING)
+
+def make_response(status_line: str, headers: dict[str, str], body: bytes) -> bytes:
+    return make_header(status_line, headers) + body
 
-def read_file_bytes(filepath: str) -> Optional[bytes]:
+def open_file(filepath: str) -> Optional[tuple[BinaryIO, os.stat_result]]:
     try:
-        with open(filepath, "rb") as f:
-            return f.read()
-    except Exception as e:
+        f = open(filepath, "rb")
+    except OSError as e:
         print(f"Cannot read file: {filepath} ({e})", file=sys.stderr)
         return None
 
-def receive_request(sock: socket.socket) -> Optional[str]:
-    buf = bytearray()
+    return f, os.fstat(f.fileno())
+
+def receive_request(sock: socket.socket, parser: RequestParser, wait: float) -> Optional[Request]:
+    """
+    Returns the next request, which may already be in `parser` if the client
+    pipelines.  With nothing buffered, waits up to `wait` seconds for the
+    request to start, as an idle connection a drain may close.  Returns None
+    if the client closes the connection or times out first.
+    """
     try:
         while True:
-            chunk = sock.recv(RECV_CHUNK)
+            req = parser.next_request()
+            if req is not None:
+                return req
+
+            if parser.has_buffered():
+                chunk = sock.recv(RECV_CHUNK)
+            else:
+                chunk = wait_for_request(sock, wait)
+                sock.settimeout(REQUEST_TIMEOUT)
             if not chunk:
-                break
-            buf += chunk
-            idx = buf.find(HEADER_END)
-            if idx != -1:
-                buf = buf[: idx + len(HEADER_END)]
-                return bytes(buf).decode(ENCODING)
+                return None
+            parser.feed(chunk)
     except socket.timeout:
-        pass
-    return None
-
-def parse_request(request_text: str) -> Optional[HttpRequest]:
-    request_line = request_text.split(CRLF, 1)[0]
-    method, path, protocol = request_line.split(" ", 2)
-    path = sanitize_path(path)
+        return None
 
+def wait_for_request(sock: socket.socket, wait: float) -> bytes:
+    with active_cond:
+        if draining:
+            return b""
+        idle.add(sock)
+    try:
+        sock.settimeout(wait)
+        return sock.recv(RECV_CHUNK)
+    finally:
+        with active_cond:
+            idle.discard(sock)
+
+def load_entry(target: str) -> Optional[CacheEntry]:
+    """
+    Resolves `target` and builds its cache entry, reading the body if the
+    file is small enough for the cache.  Returns None for anything that
+    gets a 404.
+    """
+    path = sanitize_path(target)
     if path is None:
         return None
 
-    return HttpRequest(method=method, path=path, protocol=protocol)
-
-def handle_get(sock: socket.socket, req: HttpRequest) -> None:
-    ext: str = os.path.splitext(req.path)[1]
+    ext: str = os.path.splitext(path)[1]
 
     if ext not in EXT_TO_CONTENT_TYPE and not UNSAFE_MODE:
         print(f"Unsupported extension type: {ext}")
-        sock.sendall(RESPONSE_404)
-        return
+        return None
 
     ext_type = EXT_TO_CONTENT_TYPE.get(ext)
 
-    body = read_file_bytes(req.path)
-    if body is None:
-        sock.sendall(RESPONSE_404)
-        return
+    opened = open_file(path)
+    if opened is None:
+        return None
+
+    f, st = opened
+    size = st.st_size
+    with f:
+        body = f.read() if size <= FILE_CACHE.max_body or size == 0 else None
 
+    # Strong validator: any write that changes the content changes the mtime.
+    etag = f'"{size:x}-{st.st_mtime_ns:x}"'
+    last_modified = formatdate(st.st_mtime, usegmt=True)
     headers = {
         "Content-Type": f"{ext_type}",
-        "Content-Length": str(len(body)),
-        "Connection": "close",
+        "Content-Length": str(size),
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+    }
+    if ext_type in COMPRESSIBLE_TYPES:
+        headers["Vary"] = "Accept-Encoding"
+    return CacheEntry(path=path, mtime_ns=st.st_mtime_ns, size=size, content_type=f"{ext_type}",
+                      etag=etag, last_modified=last_modified,
+                      header=make_header_lines("HTTP/1.1 200 OK", headers), body=body)
+
+def accepts_gzip(req: Request) -> bool:
+    # An explicit gzip entry wins over "*"; q=0 means "not acceptable".
+    weights: dict[str, float] = {}
+    for coding in req.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        q = 1.0
+        params = params.strip().lower()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+
+    q = weights.get("gzip", weights.get("x-gzip", weights.get("*", 0.0)))
+    return q > 0
+
+def build_gzip_variant(entry: CacheEntry, gz_path: str, gz_st: Optional[os.stat_result]) -> CacheEntry:
+    """
+    The gzip-encoded representation of `entry`, or `entry` itself when
+    compressing does not pay: the file is too large to compress per request,
+    or the result is no smaller.
+    """
+    # A .gz older than its source is left over from a previous version.
+    if gz_st is not None and gz_st.st_mtime_ns >= entry.mtime_ns:
+        path, size = gz_path, gz_st.st_size
+        body = None
+        if size <= GZIP_CACHE.max_body:
+            opened = open_file(gz_path)
+            if opened is None:
+                return entry
+            with opened[0] as f:
+                body = f.read()
+            size = len(body)
+    else:
+        if entry.size > GZIP_MAX_FILE:
+            return entry
+        data = entry.body
+        if data is None:
+            opened = open_file(entry.path)
+            if opened is None:
+                return entry
+            with opened[0] as f:
+                data = f.read()
+        body = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+        path, size = entry.path, len(body)
+
+    if size >= entry.size:
+        return entry
+
+    etag = entry.etag[:-1] + '-gzip"'
+    headers = {
+        "Content-Type": entry.content_type,
+        "Content-Encoding": "gzip",
+        "Content-Length": str(size),
+        "ETag": etag,
+        "Last-Modified": entry.last_modified,
+        "Vary": "Accept-Encoding",
     }
-    resp = make_response("HTTP/1.1 200 OK", headers, body)
-    sock.sendall(resp)
+    return CacheEntry(path=path, mtime_ns=entry.mtime_ns, size=size, content_type=entry.content_type,
+                      etag=etag, last_modified=entry.last_modified,
+                      header=make_header_lines("HTTP/1.1 200 OK", headers), body=body)
+
+def gzip_variant(entry: CacheEntry) -> CacheEntry:
+    # A .gz too large to keep is sent from disk, so a regenerated or
+    # removed one must not match the entry made for the old file.
+    gz_path = entry.path + ".gz"
+    try:
+        gz_st: Optional[os.stat_result] = os.stat(gz_path)
+    except OSError:
+        gz_st = None
+
+    gz_version = f"{gz_st.st_mtime_ns}:{gz_st.st_size}" if gz_st is not None else "-"
+    key = f"{entry.path}:{entry.mtime_ns}:{entry.size}:{gz_version}"
+    variant = GZIP_CACHE.get(key, revalidate=False)
+    if variant is None:
+        variant = build_gzip_variant(entry, gz_path, gz_st)
+        GZIP_CACHE.put(key, variant)
+    return variant
+
+def etag_matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match calls for.
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def modified_since(header: str, entry: CacheEntry) -> bool:
+    try:
+        since = parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return True
+    # HTTP dates have whole seconds.
+    return entry.mtime_ns // 1_000_000_000 > since
+
+def is_not_modified(req: Request, entry: CacheEntry) -> bool:
+    # If-Modified-Since only counts when there is no If-None-Match.
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, entry.etag)
+
+    if_modified_since = req.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        return not modified_since(if_modified_since, entry)
+    return False
+
+def parse_ranges(header: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """
+    Parses a "bytes=" Range header into (first, last) byte positions,
+    inclusive and clamped to the file.  Returns None if the header should be
+    ignored, or an empty list if no range overlaps the file.
+    """
+    unit, sep, spec = header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
 
-def dispatch_request(sock: socket.socket, request_text: str) -> None:
-    req = parse_request(request_text)
-    if req is None:
-        sock.sendall(RESPONSE_404)
-        return
+    specs = spec.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges: list[tuple[int, int]] = []
+    for item in specs:
+        first_text, sep, last_text = item.strip().partition("-")
+        try:
+            if not sep:
+                return None
+            if not first_text:
+                # Suffix range: the last N bytes.
+                suffix = int(last_text)
+                if suffix <= 0:
+                    continue
+                first, last = max(0, size - suffix), size - 1
+            else:
+                first = int(first_text)
+                last = int(last_text) if last_text else size - 1
+                if first < 0 or (last_text and last < first):
+                    return None
+        except ValueError:
+            return None
+
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    return ranges
+
+def requested_ranges(req: Request, entry: CacheEntry) -> Optional[list[tuple[int, int]]]:
+    header = req.headers.get("range")
+    if header is None:
+        return None
 
+    # A Range made against an older version of the file is void.
+    if_range = req.headers.get("if-range")
+    if if_range is not None:
+        if if_range.startswith(("\"", "W/")):
+            if if_range.strip() != entry.etag:
+                return None
+        elif modified_since(if_range, entry):
+            return None
+
+    return parse_ranges(header, entry.size)
+
+def connection_header(keep_alive: bool) -> dict[str, str]:
+    return {"Connection": "keep-alive" if keep_alive else "close"}
+
+def response_404(keep_alive: bool) -> Response:
+    return Response([RESPONSE_404_KEEP_ALIVE if keep_alive else RESPONSE_404])
+
+def not_modified_response(entry: CacheEntry, keep_alive: bool) -> Response:
+    headers = {"ETag": entry.etag, "Last-Modified": entry.last_modified}
+    if entry.content_type in COMPRESSIBLE_TYPES:
+        headers["Vary"] = "Accept-Encoding"
+    headers |= connection_header(keep_alive)
+    return Response([make_header("HTTP/1.1 304 Not Modified", headers)])
+
+def unsatisfiable_response(entry: CacheEntry, keep_alive: bool) -> Response:
+    headers = {"Content-Range": f"bytes */{entry.size}", "Content-Length": "0"} | connection_header(keep_alive)
+    return Response([make_header("HTTP/1.1 416 Range Not Satisfiable", headers)])
+
+def file_part(entry: CacheEntry, first: int, last: int) -> Union[bytes, tuple[int, int]]:
+    if entry.body is not None:
+        return entry.body[first:last + 1]
+    return (first, last - first + 1)
+
+def ranges_response(entry: CacheEntry, ranges: list[tuple[int, int]], keep_alive: bool) -> Response:
+    headers = {"ETag": entry.etag, "Last-Modified": entry.last_modified}
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        headers |= {
+            "Content-Type": entry.content_type,
+            "Content-Range": f"bytes {first}-{last}/{entry.size}",
+            "Content-Length": str(last - first + 1),
+        }
+        parts = [(b"", first, last)]
+        tail = b""
+    else:
+        # Each part: boundary line, its own headers, the bytes, CRLF.
+        parts = []
+        for first, last in ranges:
+            part_head = (f"--{MULTIPART_BOUNDARY}{CRLF}"
+                         f"Content-Type: {entry.content_type}{CRLF}"
+                         f"Content-Range: bytes {first}-{last}/{entry.size}{CRLF}{CRLF}")
+            parts.append((part_head.encode(ENCODING), first, last))
+        tail = f"--{MULTIPART_BOUNDARY}--{CRLF}".encode(ENCODING)
+        length = len(tail) + sum(len(head) + last - first + 1 + len(CRLF) for head, first, last in parts)
+        headers |= {
+            "Content-Type": f"multipart/byteranges; boundary={MULTIPART_BOUNDARY}",
+            "Content-Length": str(length),
+        }
+
+    headers |= connection_header(keep_alive)
+
+    response = Response([make_header("HTTP/1.1 206 Partial Content", headers)],
+                        None if entry.body is not None else entry.path)
+    for index, (part_head, first, last) in enumerate(parts):
+        if index:
+            part_head = CRLF.encode(ENCODING) + part_head
+        if part_head:
+            response.parts.append(part_head)
+        response.parts.append(file_part(entry, first, last))
+    if tail:
+        response.parts.append(CRLF.encode(ENCODING) + tail)
+    return response
+
+def entry_response(entry: CacheEntry, keep_alive: bool) -> Response:
+    head = entry.header + (END_KEEP_ALIVE if keep_alive else END_CLOSE)
+
+    if entry.body is not None:
+        return Response([head + entry.body])
+
+    # The body goes from the page cache to the socket with sendfile(2),
+    # so memory per request does not grow with the file.
+    return Response([head, (0, entry.size)], entry.path)
+
+def get_response(req: Request, keep_alive: bool) -> Response:
+    entry = FILE_CACHE.get(req.target)
+    if entry is None:
+        entry = load_entry(req.target)
+        if entry is None:
+            return response_404(keep_alive)
+        FILE_CACHE.put(req.target, entry)
+
+    # Ranges are served from the identity encoding only.
+    if entry.content_type in COMPRESSIBLE_TYPES and "range" not in req.headers and accepts_gzip(req):
+        entry = gzip_variant(entry)
+
+    if is_not_modified(req, entry):
+        return not_modified_response(entry, keep_alive)
+
+    ranges = requested_ranges(req, entry)
+    if ranges is None:
+        return entry_response(entry, keep_alive)
+    elif not ranges:
+        return unsatisfiable_response(entry, keep_alive)
+    else:
+        return ranges_response(entry, ranges, keep_alive)
+
+def build_response(req: Request, keep_alive: bool) -> Response:
     if req.method.upper() == "GET":
-        handle_get(sock, req)
+        return get_response(req, keep_alive)
     else:
-        sock.sendall(RESPONSE_404)
+        return response_404(keep_alive)
+
+def open_response_file(response: Response) -> Optional[BinaryIO]:
+    # Opened before anything is sent, so a file gone since it was cached
+    # can still get a 404.
+    if response.path is None:
+        return None
+    opened = open_file(response.path)
+    return opened[0] if opened is not None else None
+
+def send_response(sock: socket.socket, response: Response, keep_alive: bool) -> None:
+    f = open_response_file(response)
+    if f is None and response.path is not None:
+        response = response_404(keep_alive)
+
+    try:
+        last = len(response.parts) - 1
+        for index, part in enumerate(response.parts):
+            if isinstance(part, tuple):
+                sock.sendfile(f, *part)
+            else:
+                sock.sendall(part, SEND_MORE if index < last else 0)
+    finally:
+        if f is not None:
+            f.close()
 
 def handle_connection(inc_conn: Tuple[socket.socket, Addr]) -> None:
     sock, addr = inc_conn
+    parser = RequestParser(max_body=MAX_REQUEST_BODY)
     with sock:
-        sock.settimeout(2.0)
-        request_text = receive_request(sock)
-        if request_text is None:
-            print(f"Could not read full header from {addr}", file=sys.stderr)
-            return
+        for served in range(1, MAX_REQUESTS + 1):
+            wait = REQUEST_TIMEOUT if served == 1 else KEEPALIVE_TIMEOUT
+            try:
+                req = receive_request(sock, parser, wait)
+            except HttpParseError as e:
+                print(f"Bad request from {addr}: {e}", file=sys.stderr)
+                sock.sendall(error_response(e))
+                return
+
+            if req is None:
+                if parser.has_buffered() or served == 1:
+                    print(f"Could not read full header from {addr}", file=sys.stderr)
+                return
+
+            print(f"Request received from {addr}:")
+            print(req.head)
+            keep_alive = req.keep_alive() and served < MAX_REQUESTS and not draining
+            send_response(sock, build_response(req, keep_alive), keep_alive)
+            if not keep_alive:
+                return
+
+def serve_connection(inc_conn: Tuple[socket.socket, Addr]) -> None:
+    sock, addr = inc_conn
+    try:
+        handle_connection(inc_conn)
+    except Exception as e:
+        # The pool would otherwise swallow it silently.
+        print(f"Error serving {addr}: {e}", file=sys.stderr)
+    finally:
+        with active_cond:
+            active.discard(sock)
+            active_cond.notify_all()
+
+def wait_for_slot(max_connections: int) -> None:
+    with active_cond:
+        while len(active) >= max_connections:
+            active_cond.wait()
+
+def drain(timeout: float) -> None:
+    global draining
+
+    deadline = time.monotonic() + timeout
+    with active_cond:
+        draining = True
+        # Nobody is waiting on these; a request already under way finishes.
+        for sock in idle:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        while active:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            active_cond.wait(remaining)
+        leftover = list(active)
 
-        print(f"Request received from {addr}:")
-        print(request_text)
-        dispatch_request(sock, request_text)
+    if leftover:
+        print(f"Drain timed out, closing {len(leftover)} connections.", file=sys.stderr)
+    for sock in leftover:
+        # Wakes the thread blocked on it; it then closes the socket itself.
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+async def receive_request_async(sock: socket.socket, parser: RequestParser, wait: float) -> Optional[Request]:
+    """
+    receive_request for the event loop.  Here REQUEST_TIMEOUT bounds the
+    whole request from its first byte, not each read.
+    """
+    loop = asyncio.get_running_loop()
+    req = parser.next_request()
+    if req is not None:
+        return req
 
-def main(argc: int, argv: list[str]) -> None:
-    global ROOT_DIR, UNSAFE_MODE
+    try:
+        if not parser.has_buffered():
+            if draining:
+                return None
+            idle.add(sock)
+            try:
+                async with asyncio.timeout(wait):
+                    chunk = await loop.sock_recv(sock, RECV_CHUNK)
+            finally:
+                idle.discard(sock)
+            if not chunk:
+                return None
+            parser.feed(chunk)
 
-    port = DEFAULT_PORT
+        async with asyncio.timeout(REQUEST_TIMEOUT):
+            while True:
+                req = parser.next_request()
+                if req is not None:
+                    return req
+                chunk = await loop.sock_recv(sock, RECV_CHUNK)
+                if not chunk:
+                    return None
+                parser.feed(chunk)
+    except TimeoutError:
+        return None
 
-    for arg in argv[1:]:
-        if arg == "--unsafe":
-            UNSAFE_MODE = True
-        else:
+async def send_response_async(sock: socket.socket, response: Response, keep_alive: bool) -> None:
+    loop = asyncio.get_running_loop()
+    f = open_response_file(response)
+    if f is None and response.path is not None:
+        response = response_404(keep_alive)
+
+    try:
+        for part in response.parts:
+            if isinstance(part, tuple):
+                offset, count = part
+                end = offset + count
+                for start in range(offset, end, ASYNC_SEND_CHUNK):
+                    async with asyncio.timeout(REQUEST_TIMEOUT):
+                        await loop.sock_sendfile(sock, f, start, min(ASYNC_SEND_CHUNK, end - start))
+            else:
+                data = memoryview(part)
+                for start in range(0, len(data), ASYNC_SEND_CHUNK):
+                    async with asyncio.timeout(REQUEST_TIMEOUT):
+                        await loop.sock_sendall(sock, data[start:start + ASYNC_SEND_CHUNK])
+    finally:
+        if f is not None:
+            f.close()
+
+async def handle_connection_async(sock: socket.socket, addr: Addr) -> None:
+    loop = asyncio.get_running_loop()
+    parser = RequestParser(max_body=MAX_REQUEST_BODY)
+    with sock:
+        for served in range(1, MAX_REQUESTS + 1):
+            wait = REQUEST_TIMEOUT if served == 1 else KEEPALIVE_TIMEOUT
             try:
-                port = int(arg)
-            except ValueError:
-                print(f"Ignoring unrecognized argument: {arg}", file=sys.stderr)
+                req = await receive_request_async(sock, parser, wait)
+            except HttpParseError as e:
+                print(f"Bad request from {addr}: {e}", file=sys.stderr)
+                await loop.sock_sendall(sock, error_response(e))
+                return
+
+            if req is None:
+                if parser.has_buffered() or served == 1:
+                    print(f"Could not read full header from {addr}", file=sys.stderr)
+                return
+
+            keep_alive = req.keep_alive() and served < MAX_REQUESTS and not draining
+            # Opening, statting and compressing files blocks, so it runs on
+            # the default executor instead of stalling every other connection.
+            response = await loop.run_in_executor(None, build_response, req, keep_alive)
+            await send_response_async(sock, response, keep_alive)
+            if not keep_alive:
+                return
+
+async def serve_connection_async(sock: socket.socket, addr: Addr) -> None:
+    try:
+        await handle_connection_async(sock, addr)
+    except TimeoutError:
+        print(f"Error serving {addr}: timed out", file=sys.stderr)
+    except Exception as e:
+        print(f"Error serving {addr}: {e}", file=sys.stderr)
+    finally:
+        active.discard(sock)
+
+async def accept_connections(server_sock: socket.socket, max_connections: int) -> None:
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_connections)
+
+    def finished(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        slots.release()
+
+    while True:
+        await slots.acquire()
+        sock, addr = await loop.sock_accept(server_sock)
+        print(f"Connection accepted from {addr}")
+        active.add(sock)
+        task = asyncio.create_task(serve_connection_async(sock, addr))
+        tasks.add(task)
+        task.add_done_callback(finished)
+
+async def drain_async(timeout: float) -> None:
+    global draining
+
+    draining = True
+    for sock in idle:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        print(f"Drain timed out, closing {len(pending)} connections.", file=sys.stderr)
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+
+async def serve_async(server_sock: socket.socket, max_connections: int, drain_timeout: float) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    server_sock.setblocking(False)
+    accepting = asyncio.create_task(accept_connections(server_sock, max_connections))
+    await stop.wait()
+
+    print("Signal received, draining connections...")
+    accepting.cancel()
+    # Stop accepting first, so new clients are refused rather than queued.
+    server_sock.close()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: None)
+    await drain_async(drain_timeout)
+
+def raise_fd_limit(wanted: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+
+    limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    if limit < wanted:
+        print(f"Open file limit is {limit}; fewer than the requested connections can be served.",
+              file=sys.stderr)
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="better-webserver.py")
+    parser.add_argument("port", type=int, nargs="?", default=DEFAULT_PORT)
+    parser.add_argument("--unsafe", action="store_true",
+                        help="serve any path under the working directory, skipping the traversal check")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve every connection from one asyncio event loop instead of a thread pool")
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help="connections served at once; more wait in the listen backlog "
+                             f"(default {DEFAULT_MAX_CONNECTIONS}, or {DEFAULT_ASYNC_MAX_CONNECTIONS} with --asyncio)")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="seconds in-flight requests get to finish on shutdown")
+    parser.add_argument("--keep-alive-timeout", type=float, default=KEEPALIVE_TIMEOUT,
+                        help="seconds a persistent connection may wait idle for its next request")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS,
+                        help="requests served on one connection before it is closed")
+    parser.add_argument("--cache-bytes", type=int, default=DEFAULT_CACHE_BYTES,
+                        help="memory budget of the file cache; 0 disables it")
+    parser.add_argument("--cache-max-file", type=int, default=DEFAULT_CACHE_MAX_FILE,
+                        help="largest file whose contents are cached")
+    parser.add_argument("--gzip-cache-bytes", type=int, default=DEFAULT_GZIP_CACHE_BYTES,
+                        help="memory budget for gzipped variants of text files; 0 compresses per request")
+    return parser.parse_args(argv[1:])
+
+def main(argc: int, argv: list[str]) -> None:
+    global ROOT_DIR, UNSAFE_MODE, KEEPALIVE_TIMEOUT, MAX_REQUESTS, FILE_CACHE, GZIP_CACHE
+
+    args = parse_args(argv)
+    port: int = args.port
+    UNSAFE_MODE = args.unsafe
+    KEEPALIVE_TIMEOUT = args.keep_alive_timeout
+    MAX_REQUESTS = max(1, args.max_requests)
+    FILE_CACHE = FileCache(args.cache_bytes, args.cache_max_file)
+    GZIP_CACHE = FileCache(args.gzip_cache_bytes, args.cache_max_file)
+
+    max_connections: int = args.max_connections or (
+        DEFAULT_ASYNC_MAX_CONNECTIONS if args.asyncio else DEFAULT_MAX_CONNECTIONS)
 
     mode: str = "unsafe" if UNSAFE_MODE else "safe"
     print(f"Starting simple webserver in {mode} mode.")
 
+    if args.asyncio:
+        # Room for the listener, stdio and files being sent besides the connections.
+        raise_fd_limit(max_connections + 64)
+        with socket.socket() as server_sock:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_sock.bind(("", port))
+            server_sock.listen(LISTEN_BACKLOG)
+            print(f"Webserver listening on port {port} with asyncio, serving up to {max_connections} connections")
+            asyncio.run(serve_async(server_sock, max_connections, args.drain_timeout))
+        print(FILE_CACHE.stats())
+        print(GZIP_CACHE.stats("gzip cache"))
+        return
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
     with socket.socket() as server_sock:
         server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_sock.bind(("", port))
-        server_sock.listen()
-        print(f"Webserver listening on port {port}")
+        server_sock.listen(LISTEN_BACKLOG)
+        print(f"Webserver listening on port {port}, serving up to {max_connections} connections")
 
-        try:
-            while True:
-                conn = server_sock.accept()
-                print(f"Connection accepted from {conn[1]}")
-                handle_connection(conn)
-        except KeyboardInterrupt:
-            print("KeyboardInterrupt hit, stopping server...")
+        with ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="worker") as pool:
+            try:
+                while True:
+                    wait_for_slot(max_connections)
+                    conn = server_sock.accept()
+                    print(f"Connection accepted from {conn[1]}")
+                    with active_cond:
+                        active.add(conn[0])
+                    pool.submit(serve_connection, conn)
+            except KeyboardInterrupt:
+                print("KeyboardInterrupt hit, draining connections...")
+                # Stop accepting first, so new clients are refused rather than queued.
+                server_sock.close()
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                drain(args.drain_timeout)
+                print(FILE_CACHE.stats())
+                print(GZIP_CACHE.stats("gzip cache"))
 
 if __name__ == "__main__":
     main(len(sys.argv), sys.argv)
@@ -0,0 +1,120 @@
+"""
+In-memory LRU cache for better-webserver, keyed by the request's URL path.
+
+An entry holds what answering a GET for that path takes: the resolved file
+path, the response headers already encoded, and for small files the body.
+A hit skips path resolution and header building, and for a cached body the
+read as well; it costs one stat() to check the file's mtime and size still
+match.  Entries that no longer match are dropped and rebuilt by the caller.
+
+The cache is bounded by the bytes its entries hold and evicts the least
+recently used first.  It is shared by the pool threads, so every operation
+takes `lock`; the stat() happens outside it.
+"""
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+# Rough cost of an entry's bookkeeping, counted against the byte budget
+# along with the data it holds.
+ENTRY_OVERHEAD = 256
+
+@dataclass
+class CacheEntry:
+    path: str
+    mtime_ns: int
+    size: int
+    content_type: str
+    # Validators sent with every response for this file.
+    etag: str
+    last_modified: str
+    # Status line and headers, without the Connection header and the blank
+    # line that ends them; those depend on the request.
+    header: bytes
+    # The whole file if it is small enough to keep, else None.
+    body: Optional[bytes]
+
+    def cost(self) -> int:
+        return ENTRY_OVERHEAD + len(self.path) + len(self.header) + (len(self.body) if self.body else 0)
+
+    def matches(self, st: os.stat_result) -> bool:
+        return st.st_mtime_ns == self.mtime_ns and st.st_size == self.size
+
+class FileCache:
+    def __init__(self, max_bytes: int, max_body: int):
+        self.max_bytes = max_bytes
+        # Largest file whose body is kept; larger ones are cached without it.
+        self.max_body = max_body
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key: str, revalidate: bool = True) -> Optional[CacheEntry]:
+        """
+        Returns the entry for `key` if its file is unchanged.  Pass
+        revalidate=False when the key itself identifies the file's version.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if not revalidate:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry
+
+        try:
+            st: Optional[os.stat_result] = os.stat(entry.path)
+        except OSError:
+            st = None
+
+        with self.lock:
+            if st is None or not entry.matches(st):
+                self.stale += 1
+                self.misses += 1
+                self._remove(key, entry)
+                return None
+
+            self.hits += 1
+            if self.entries.get(key) is entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        cost = entry.cost()
+        if cost > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.cost()
+
+            self.entries[key] = entry
+            self.nbytes += cost
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.cost()
+                self.evictions += 1
+
+    def _remove(self, key: str, entry: CacheEntry) -> None:
+        # Another thread may already have replaced a stale entry.
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+            self.nbytes -= entry.cost()
+
+    def stats(self, name: str = "file cache") -> str:
+        with self.lock:
+            lookups = self.hits + self.misses
+            ratio = self.hits / lookups if lookups else 0.0
+            return (f"{name}: {len(self.entries)} entries, {self.nbytes} of {self.max_bytes} bytes, "
+                    f"{self.hits} hits, {self.misses} misses ({ratio:.1%} hit rate), "
+                    f"{self.stale} stale, {self.evictions} evictions")
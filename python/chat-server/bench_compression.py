@@ -0,0 +1,146 @@
+# Example usage:
+#
+# python bench_compression.py
+# python bench_compression.py --messages 5000 --room 500
+#
+# Compares the v2 encodings a compressing connection can receive, over a
+# synthetic transcript of chat lines and one of pasted log lines:
+#
+#   plain  : v2 frames, no compression
+#   shared : Packet.shared_frames(), each message deflated on its own against
+#            the preset dictionary (what --compression shared broadcasts)
+#   stream : one Compressor per connection, earlier messages act as the
+#            dictionary (what --compression stream sends)
+#
+# For each it reports bytes on the wire per message, sender and receiver CPU
+# per message, and the sender CPU for one broadcast to a room of --room
+# users: plain and shared encode once per broadcast, stream once per member.
+# The last table is the memory a connection's compression state holds.
+
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+from packet import Packet, PacketType, PacketReader, Compressor, FRAMING_V2, _inflater
+
+NAMES: list[str] = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+WORDS: tuple[str, ...] = tuple((
+    "the a and to you that it is for on in with this have just what not but are was can will "
+    "deploy build server test fixed broken merge branch lunch today tomorrow meeting review "
+    "anyone know why does this again thanks great sounds good later yes no maybe").split())
+
+
+def chat_lines(count: int, rng: random.Random) -> list[str]:
+    lines = []
+    for _ in range(count):
+        name = rng.choice(NAMES)
+        roll = rng.random()
+        if roll < 0.05:
+            lines.append(f"*** {name} has joined the chat. ***")
+        elif roll < 0.10:
+            lines.append(f"*** {name} has left the chat. ***")
+        elif roll < 0.15:
+            lines.append(f"[{name} {' '.join(rng.choices(WORDS, k=rng.randint(2, 5)))}]")
+        else:
+            lines.append(f"{name}: {' '.join(rng.choices(WORDS, k=rng.randint(3, 16)))}")
+    return lines
+
+
+def log_lines(count: int, rng: random.Random) -> list[str]:
+    lines = []
+    for _ in range(count):
+        entries = []
+        for _ in range(20):
+            level = rng.choice(["INFO", "INFO", "INFO", "WARN", "ERROR"])
+            entries.append(f"2024-05-0{rng.randint(1, 9)} 12:{rng.randint(10, 59)}:{rng.randint(10, 59)} "
+                           f"{level} worker-{rng.randint(1, 8)} request {rng.randint(1000, 9999)} "
+                           f"{' '.join(rng.choices(WORDS, k=6))}")
+        lines.append(f"{rng.choice(NAMES)}: " + "\n".join(entries))
+    return lines
+
+
+def encode_plain(packets: list[Packet]) -> list[list[bytes]]:
+    return [pkt.frames(FRAMING_V2) for pkt in packets]
+
+
+def encode_shared(packets: list[Packet]) -> list[list[bytes]]:
+    return [pkt.shared_frames() for pkt in packets]
+
+
+def encode_stream(packets: list[Packet]) -> list[list[bytes]]:
+    compressor = Compressor()
+    return [compressor.frames(pkt) for pkt in packets]
+
+
+def fresh(texts: list[str]) -> list[Packet]:
+    # New packets every run: frames() and shared_frames() cache their result.
+    return [Packet(PacketType.CHAT, text) for text in texts]
+
+
+def measure(encode, texts: list[str], repeat: int = 3) -> tuple[float, float, float]:
+    """Returns bytes per message, sender us per message and receiver us per message."""
+    best_send = best_recv = float("inf")
+    wire = b""
+
+    for _ in range(repeat):
+        packets = fresh(texts)
+        start = time.perf_counter()
+        encoded = encode(packets)
+        best_send = min(best_send, time.perf_counter() - start)
+        wire = b"".join(frame for frames in encoded for frame in frames)
+
+        reader = PacketReader()
+        reader.framing = FRAMING_V2
+        start = time.perf_counter()
+        decoded = reader.feed(wire)
+        best_recv = min(best_recv, time.perf_counter() - start)
+        assert [pkt.payload for pkt in decoded] == texts
+
+    count = len(texts)
+    return len(wire) / count, best_send / count * 1e6, best_recv / count * 1e6
+
+
+def state_kib(make) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = make()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return (after - before) / 1024
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bench_compression.py")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--room", type=int, default=100, help="room size for the broadcast column")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv[1:])
+
+    rng = random.Random(args.seed)
+    corpora = {
+        "chat": chat_lines(args.messages, rng),
+        "paste": log_lines(max(1, args.messages // 20), rng),
+    }
+    encodings = {"plain": encode_plain, "shared": encode_shared, "stream": encode_stream}
+
+    print(f"{'corpus':>6} {'encoding':>8} {'bytes/msg':>10} {'ratio':>6} {'send us':>8} {'recv us':>8}"
+          f" {'broadcast us':>13}")
+    for corpus, texts in corpora.items():
+        raw = None
+        for name, encode in encodings.items():
+            nbytes, send_us, recv_us = measure(encode, texts)
+            raw = raw or nbytes
+            broadcast_us = send_us * args.room if name == "stream" else send_us
+            print(f"{corpus:>6} {name:>8} {nbytes:10.1f} {nbytes / raw:6.2f} {send_us:8.2f} {recv_us:8.2f}"
+                  f" {broadcast_us:13.1f}")
+
+    print()
+    print(f"compressor state per connection  : {state_kib(Compressor):6.1f} KiB")
+    print(f"decompressor state per connection: {state_kib(_inflater):6.1f} KiB")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,124 @@
+# Example usage:
+#
+# python bench_event_loop.py
+# python bench_event_loop.py 100 1000 10000
+#
+# Measures the cost of one event loop wakeup as the number of idle
+# connections grows.  Each connection is one end of a socketpair; exactly one
+# of them is made readable per round, which is the common case for a chat
+# server where most users are idle most of the time.
+#
+# select.select has to be handed the full fd list on every call (and cannot
+# go past FD_SETSIZE), while a selectors/epoll selector keeps the
+# registrations in the kernel and only returns the ready ones.
+
+import sys
+import time
+import socket
+import select
+import selectors
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_COUNTS: list[int] = [10, 100, 500, 1000, 5000, 10000]
+ROUNDS: int = 2000
+FD_SETSIZE: int = 1024
+
+
+def raise_fd_limit(wanted: int) -> int:
+    if resource is None:
+        return wanted
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        soft = new_soft
+
+    return soft
+
+
+def make_pairs(count: int) -> list[tuple[socket.socket, socket.socket]]:
+    pairs = []
+    for _ in range(count):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        pairs.append((a, b))
+    return pairs
+
+
+def bench_select(pairs: list[tuple[socket.socket, socket.socket]]) -> float:
+    readers = [a for a, _ in pairs]
+    writer = pairs[-1][1]
+    total = 0.0
+
+    for _ in range(ROUNDS):
+        writer.send(b"x")
+        start = time.perf_counter()
+        # The chat server rebuilt this list on every iteration, so it is timed too.
+        ready, _, _ = select.select([s for s in readers], [], [])
+        total += time.perf_counter() - start
+        for s in ready:
+            s.recv(16)
+
+    return total / ROUNDS
+
+
+def bench_selector(pairs: list[tuple[socket.socket, socket.socket]]) -> float:
+    sel = selectors.DefaultSelector()
+    for a, _ in pairs:
+        sel.register(a, selectors.EVENT_READ, data=a)
+
+    writer = pairs[-1][1]
+    total = 0.0
+
+    for _ in range(ROUNDS):
+        writer.send(b"x")
+        start = time.perf_counter()
+        events = sel.select()
+        total += time.perf_counter() - start
+        for key, _ in events:
+            sock: socket.socket = key.data
+            sock.recv(16)
+
+    sel.close()
+    return total / ROUNDS
+
+
+def main(argv: list[str]):
+    try:
+        counts = [int(arg) for arg in argv[1:]] or DEFAULT_COUNTS
+    except ValueError:
+        print("usage: bench_event_loop.py [connection_count ...]", file=sys.stderr)
+        return 1
+
+    limit = raise_fd_limit(2 * max(counts) + 64)
+    selector_name = type(selectors.DefaultSelector()).__name__
+
+    print(f"{'connections':>12} {'select (us)':>12} {selector_name + ' (us)':>20}")
+
+    for count in counts:
+        if 2 * count + 32 > limit:
+            print(f"{count:>12} skipped: fd limit is {limit}")
+            continue
+
+        pairs = make_pairs(count)
+        try:
+            if 2 * count + 16 < FD_SETSIZE:
+                select_cost = f"{bench_select(pairs) * 1e6:12.2f}"
+            else:
+                select_cost = f"{'n/a':>12}"
+            selector_cost = bench_selector(pairs) * 1e6
+            print(f"{count:>12} {select_cost} {selector_cost:20.2f}")
+        finally:
+            for a, b in pairs:
+                a.close()
+                b.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,107 @@
+# Example usage:
+#
+# python bench_fanout.py
+# python bench_fanout.py 100 1000 5000
+#
+# Measures the server-side cost of delivering one chat line to every user in
+# a room, as a function of room size.  Each simulated user is a socketpair
+# registered with chat_server exactly as an accepted connection would be.
+#
+#   per-recipient : the Packet is serialized once per recipient (the old
+#                   _broadcast_text behaviour)
+#   encode-once   : chat_server._broadcast_text, which serializes one frame
+#                   and queues the same bytes object for every recipient
+#
+# The receiving ends are drained between messages, outside the timed region.
+
+import sys
+import time
+import socket
+
+import chat_server
+from packet import Packet, PacketType
+from bench_event_loop import raise_fd_limit
+
+DEFAULT_SIZES: list[int] = [10, 100, 1000, 5000]
+MESSAGES: int = 50
+TEXT: str = "alice: " + "the quick brown fox jumps over the lazy dog " * 3
+
+
+def make_room(size: int) -> list[socket.socket]:
+    peers = []
+    for i in range(size):
+        server_end, client_end = socket.socketpair()
+        client_end.setblocking(False)
+        server_end.setblocking(False)
+        user = chat_server.User(server_end)
+        chat_server.add_user(user)
+        chat_server.selector.register(server_end, chat_server.selectors.EVENT_READ, data=user)
+        chat_server.set_username(user, f"user{i}")
+        chat_server.enter_room(user, chat_server.DEFAULT_ROOM)
+        peers.append(client_end)
+    return peers
+
+
+def close_room(peers: list[socket.socket]):
+    for user in list(chat_server.users_by_fd.values()):
+        chat_server.disconnect_user(user)
+    for peer in peers:
+        peer.close()
+
+
+def drain(peers: list[socket.socket]):
+    for peer in peers:
+        try:
+            while peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def per_recipient(text: str):
+    pkt = Packet(PacketType.CHAT, text)
+    for user in list(chat_server.users_by_fd.values()):
+        chat_server.queue_bytes(user, pkt.to_bytes())
+
+
+def encode_once(text: str):
+    chat_server._broadcast_text(chat_server.DEFAULT_ROOM, text)
+
+
+def time_fanout(fanout, peers: list[socket.socket]) -> float:
+    total = 0.0
+    for _ in range(MESSAGES):
+        start = time.perf_counter()
+        fanout(TEXT)
+        total += time.perf_counter() - start
+        drain(peers)
+    return total / MESSAGES
+
+
+def main(argv: list[str]):
+    try:
+        sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+    except ValueError:
+        print("usage: bench_fanout.py [room_size ...]", file=sys.stderr)
+        return 1
+
+    limit = raise_fd_limit(2 * max(sizes) + 64)
+    print(f"{'room size':>10} {'per-recipient (us)':>20} {'encode-once (us)':>18} {'us/recipient':>14}")
+
+    for size in sizes:
+        if 2 * size + 32 > limit:
+            print(f"{size:>10} skipped: fd limit is {limit}")
+            continue
+
+        peers = make_room(size)
+        try:
+            before = time_fanout(per_recipient, peers) * 1e6
+            after = time_fanout(encode_once, peers) * 1e6
+            print(f"{size:>10} {before:20.1f} {after:18.1f} {after / size:14.3f}")
+        finally:
+            close_room(peers)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,94 @@
+# Example usage:
+#
+# python bench_packet.py
+#
+# Compares encode/decode throughput of the struct-based, slotted Packet with
+# the original implementation (kept below as LegacyPacket for reference).
+
+import sys
+import timeit
+from enum import Enum
+
+from packet import Packet, PacketType, PacketReader
+
+PAYLOADS: dict[str, str] = {
+    "short": "alice: hi",
+    "line": "alice: " + "the quick brown fox jumps over the lazy dog " * 3,
+    "paste": "x" * 8000,
+}
+BATCH: int = 100
+
+
+class LegacyPacket:
+    def __init__(self, type: Enum, payload: str):
+        self.type = type
+        self.payload = payload
+
+    def to_bytes(self) -> bytes:
+        payload_bytes = self.payload.encode()
+        length = len(payload_bytes)
+
+        if length > 0xFFFF:
+            raise ValueError("Payload too large (max 65535 bytes)")
+
+        return bytes([self.type.value]) + length.to_bytes(2, "big") + payload_bytes
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'LegacyPacket':
+        type_byte = data[0]
+        length = int.from_bytes(data[1:3], 'big')
+        payload_str = data[3:3+length].decode('utf-8')
+        return cls(PacketType(type_byte), payload_str)
+
+
+def legacy_decode_stream(stream: bytes) -> int:
+    # What receive_packet did per frame: slice, copy, decode, trim the buffer.
+    buffer = bytearray(stream)
+    count = 0
+    while len(buffer) >= 3:
+        total_length = 3 + int.from_bytes(buffer[1:3], "big")
+        packet_bytes = buffer[:total_length]
+        del buffer[:total_length]
+        LegacyPacket.from_bytes(bytes(packet_bytes))
+        count += 1
+    return count
+
+
+def rate(stmt, number: int) -> float:
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return number / best
+
+
+def main(argv: list[str]):
+    print(f"{'payload':>8} {'op':>8} {'legacy (ops/s)':>16} {'new (ops/s)':>14} {'speedup':>8}")
+
+    for name, text in PAYLOADS.items():
+        legacy = LegacyPacket(PacketType.CHAT, text)
+        new = Packet(PacketType.CHAT, text)
+        frame = new.to_bytes()
+        stream = frame * BATCH
+        scratch = bytearray(len(frame))
+        number = 20000 if len(frame) < 1000 else 2000
+
+        results = [
+            ("encode",
+             rate(lambda: LegacyPacket(PacketType.CHAT, text).to_bytes(), number),
+             rate(lambda: Packet(PacketType.CHAT, text).to_bytes(), number)),
+            ("pack",
+             rate(lambda: legacy.to_bytes(), number),
+             rate(lambda: new.pack_into(scratch), number)),
+            ("decode",
+             rate(lambda: LegacyPacket.from_bytes(frame), number),
+             rate(lambda: Packet.from_bytes(frame), number)),
+            ("stream",
+             rate(lambda: legacy_decode_stream(stream), number // BATCH) * BATCH,
+             rate(lambda: PacketReader().feed(stream), number // BATCH) * BATCH),
+        ]
+
+        for op, before, after in results:
+            print(f"{name:>8} {op:>8} {before:16,.0f} {after:14,.0f} {after / before:7.2f}x")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
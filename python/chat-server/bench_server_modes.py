@@ -0,0 +1,157 @@
+# Example usage:
+#
+# python bench_server_modes.py
+# python bench_server_modes.py --clients 2000 --senders 20 --messages 200
+#
+# Starts chat_server.py once per event loop (selectors, --asyncio, then
+# --workers with one worker per core), connects --clients users, and reports:
+#
+#   rss idle  : server resident memory once every client has said HELLO
+#               (for --workers, the hub process only)
+#   deliveries: CHAT frames delivered per second while --senders users each
+#               send --messages lines and every client reads the broadcasts
+#
+# Everything runs on localhost; the clients live in this process and are
+# driven by a single selector.
+
+import os
+import sys
+import time
+import socket
+import argparse
+import selectors
+import subprocess
+
+from packet import Packet, PacketType, PacketReader
+from bench_event_loop import raise_fd_limit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODES: dict[str, list[str]] = {
+    "selectors": [],
+    "asyncio": ["--asyncio"],
+    "workers": ["--workers", str(max(2, os.cpu_count() or 2))],
+}
+
+
+def server_rss_kib(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def start_server(port: int, extra: list[str]) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "chat_server.py"), str(port), "--high-water", str(64 * 1024 * 1024),
+         "--no-rate-limit"] + extra,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("chat_server did not start")
+
+
+def connect_clients(port: int, count: int, sel: selectors.BaseSelector) -> list[socket.socket]:
+    clients = []
+    for i in range(count):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(Packet(PacketType.HELLO, f"bench{i}").to_bytes())
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, data=PacketReader())
+        clients.append(s)
+    return clients
+
+
+def pump(sel: selectors.BaseSelector, timeout: float) -> int:
+    """Reads whatever is ready and returns the number of CHAT frames seen."""
+    chats = 0
+    for key, _ in sel.select(timeout):
+        try:
+            data = key.fileobj.recv(256 * 1024)
+        except BlockingIOError:
+            continue
+        if not data:
+            sel.unregister(key.fileobj)
+            continue
+        for pkt in key.data.feed(data):
+            if pkt.type is PacketType.CHAT:
+                chats += 1
+    return chats
+
+
+def run_mode(name: str, extra: list[str], args: argparse.Namespace) -> tuple[int, float]:
+    proc = start_server(args.port, extra)
+    sel = selectors.DefaultSelector()
+    clients: list[socket.socket] = []
+
+    try:
+        clients = connect_clients(args.port, args.clients, sel)
+
+        # Let the join announcements settle before measuring.
+        while pump(sel, 0.5):
+            pass
+        rss = server_rss_kib(proc.pid)
+
+        senders = clients[:args.senders]
+        frame = Packet(PacketType.CHAT, "benchmark line " * 4).to_bytes()
+        expected = args.senders * args.messages * args.clients
+        delivered = 0
+
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            for s in senders:
+                s.setblocking(True)
+                s.sendall(frame)
+                s.setblocking(False)
+            delivered += pump(sel, 0)
+
+        while delivered < expected:
+            got = pump(sel, 2.0)
+            if not got:
+                break
+            delivered += got
+        elapsed = time.perf_counter() - start
+
+        if delivered < expected:
+            print(f"{name}: only {delivered}/{expected} deliveries arrived", file=sys.stderr)
+
+        return rss, delivered / elapsed
+    finally:
+        for s in clients:
+            s.close()
+        sel.close()
+        proc.terminate()
+        proc.wait()
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bench_server_modes.py")
+    parser.add_argument("--port", type=int, default=34567)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100)
+    args = parser.parse_args(argv[1:])
+
+    raise_fd_limit(args.clients + 64)
+
+    print(f"{'mode':>10} {'rss idle (KiB)':>15} {'deliveries/s':>14}")
+    for name, extra in MODES.items():
+        rss, rate = run_mode(name, extra, args)
+        print(f"{name:>10} {rss:15,} {rate:14,.0f}")
+        time.sleep(0.5)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,335 @@
+"""
+Local message bus for the sharded (--workers N) chat server.
+
+The parent process runs the hub: one Unix socketpair per worker, the global
+username registry, and relaying of broadcasts, DMs and /users queries
+between workers.  Workers only ever talk to the hub, never to each other.
+
+Bus message structure:
+    Byte1   : BusType enum
+    Byte2-5 : Payload Length, 4 byte unsigned big-endian
+    Byte6   : Payload, UTF-8 fields, each preceded by its byte length as a
+              4 byte unsigned big-endian; fields carry client text, so no
+              byte value can serve as a separator
+"""
+from enum import Enum
+import os
+import sys
+import signal
+import socket
+import struct
+import bisect
+import logging
+import selectors
+
+BUS_HEADER: struct.Struct = struct.Struct(">BI")
+FIELD_LEN: struct.Struct = struct.Struct(">I")
+BUS_READ_SIZE: int = 256 * 1024
+
+log: logging.Logger = logging.getLogger("chat_server.bus")
+
+class BusType(Enum):
+    CLAIM     = 0  # worker -> hub: fd, name
+    CLAIMED   = 1  # hub -> worker: fd, name, "1" if granted else "0"
+    RELEASE   = 2  # worker -> hub: name
+    BROADCAST = 3  # worker -> hub -> other workers: room, text
+    DM        = 4  # worker -> hub: fd, sender, target, text
+    DM_RESULT = 5  # hub -> worker: fd, target, display name ("" if offline), text
+    DELIVER   = 6  # hub -> owning worker: sender, target, text
+    USERS     = 7  # worker -> hub: fd; hub -> worker: fd, names...
+    ENTER     = 8  # worker -> hub: room (one of its users joined it)
+    LEAVE     = 9  # worker -> hub: room (one of its users left it)
+    ROOMS     = 10 # worker -> hub: fd; hub -> worker: fd, room, count, room, count...
+
+
+def encode(type: BusType, *fields: str) -> bytes:
+    payload = bytearray()
+    for field in fields:
+        data = field.encode()
+        payload += FIELD_LEN.pack(len(data))
+        payload += data
+    return BUS_HEADER.pack(type.value, len(payload)) + payload
+
+
+def decode_fields(payload: bytes | bytearray) -> list[str]:
+    fields: list[str] = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = FIELD_LEN.unpack_from(payload, offset)
+        start = offset + FIELD_LEN.size
+        if start + length > len(payload):
+            raise ValueError("bus field runs past the end of its message")
+        fields.append(payload[start:start+length].decode())
+        offset = start + length
+    return fields
+
+
+class BusLink:
+    """
+    One end of a worker<->hub socketpair, registered with `selector`.
+    Writes never block: what the kernel does not take is kept in `outbuf`
+    and flushed when the socket becomes write-ready.
+    """
+    def __init__(self, sock: socket.socket, selector: selectors.BaseSelector, worker: int = -1):
+        sock.setblocking(False)
+        self.sock = sock
+        self.selector = selector
+        self.worker = worker
+        self.buffer = bytearray()
+        self.outbuf = bytearray()
+        self.want_write = False
+        self.dropped_messages = 0
+        selector.register(sock, selectors.EVENT_READ, data=self)
+
+    def send(self, type: BusType, *fields: str):
+        self.outbuf += encode(type, *fields)
+        self.flush()
+
+    def flush(self):
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                sent = 0
+            del self.outbuf[:sent]
+
+        want_write = bool(self.outbuf)
+        if want_write != self.want_write:
+            self.want_write = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(self.sock, events, data=self)
+
+    def read(self) -> list[tuple[BusType, list[str]]] | None:
+        """
+        Returns every complete message now available, or None on EOF.
+        """
+        try:
+            data = self.sock.recv(BUS_READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        if not data:
+            return None
+
+        self.buffer += data
+        messages: list[tuple[BusType, list[str]]] = []
+        offset = 0
+        end = len(self.buffer)
+
+        while end - offset >= BUS_HEADER.size:
+            type_byte, length = BUS_HEADER.unpack_from(self.buffer, offset)
+            start = offset + BUS_HEADER.size
+            if end - start < length:
+                break
+            messages.append((BusType(type_byte), decode_fields(self.buffer[start:start+length])))
+            offset = start + length
+
+        if offset:
+            del self.buffer[:offset]
+
+        return messages
+
+    def close(self):
+        try:
+            self.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+
+
+class Hub:
+    """
+    Owns the global view: which worker each username lives on, kept in a
+    case-folded dict plus a sorted list for /users, like the per-process
+    indexes in chat_server, and how many members each worker has in each room.
+
+    A worker that stops reading gets the same treatment as a slow user: once
+    its link's backlog would pass `high_water` bytes, `slow_policy` either
+    drops the new message or drops the worker.
+    """
+    def __init__(self, high_water: int, slow_policy: str):
+        self.high_water = high_water
+        self.slow_policy = slow_policy
+        self.selector = selectors.DefaultSelector()
+        self.links: list[BusLink] = []
+        self.owners: dict[str, tuple[int, str]] = {}
+        self.sorted_names: list[str] = []
+        self.room_counts: dict[int, dict[str, int]] = {}
+
+    def add_worker(self, sock: socket.socket):
+        self.links.append(BusLink(sock, self.selector, worker=len(self.links)))
+
+    def _claim(self, worker: int, name: str) -> bool:
+        key = name.casefold()
+        if key in self.owners:
+            return False
+        self.owners[key] = (worker, name)
+        bisect.insort(self.sorted_names, name, key=str.casefold)
+        return True
+
+    def _release(self, worker: int, name: str):
+        key = name.casefold()
+        owner = self.owners.get(key)
+        if owner is None or owner[0] != worker:
+            return
+        del self.owners[key]
+        idx = bisect.bisect_left(self.sorted_names, key, key=str.casefold)
+        del self.sorted_names[idx]
+
+    def _room_totals(self) -> dict[str, int]:
+        totals: dict[str, int] = {}
+        for counts in self.room_counts.values():
+            for room, count in counts.items():
+                totals[room] = totals.get(room, 0) + count
+        return totals
+
+    def _worker_lost(self, link: BusLink):
+        log.warning("Worker %d bus closed, releasing its users.", link.worker)
+        for key, (worker, name) in list(self.owners.items()):
+            if worker == link.worker:
+                self._release(worker, name)
+        self.room_counts.pop(link.worker, None)
+        link.close()
+        self.links = [l for l in self.links if l is not link]
+
+    def _send(self, link: BusLink, type: BusType, *fields: str):
+        message = encode(type, *fields)
+        backlog = len(link.outbuf)
+        if backlog and backlog + len(message) > self.high_water:
+            if self.slow_policy == "drop":
+                link.dropped_messages += 1
+                if link.dropped_messages % 1000 == 1:
+                    log.warning("Worker %d is behind on the bus, %d messages dropped so far.",
+                                link.worker, link.dropped_messages)
+                return
+            log.warning("Worker %d exceeded the bus high-water mark, disconnecting.", link.worker)
+            self._worker_lost(link)
+            return
+
+        link.outbuf += message
+        link.flush()
+
+    def handle(self, link: BusLink, type: BusType, fields: list[str]):
+        match type:
+            case BusType.CLAIM:
+                fd, name = fields
+                granted = self._claim(link.worker, name)
+                self._send(link, BusType.CLAIMED, fd, name, "1" if granted else "0")
+
+            case BusType.RELEASE:
+                self._release(link.worker, fields[0])
+
+            case BusType.BROADCAST:
+                for other in self.links:
+                    if other is not link:
+                        self._send(other, BusType.BROADCAST, *fields)
+
+            case BusType.DM:
+                fd, sender, target, text = fields
+                owner = self.owners.get(target.casefold())
+                if owner is None:
+                    self._send(link, BusType.DM_RESULT, fd, target, "", text)
+                    return
+                worker, display = owner
+                for other in self.links:
+                    if other.worker == worker:
+                        self._send(other, BusType.DELIVER, sender, display, text)
+                self._send(link, BusType.DM_RESULT, fd, target, display, text)
+
+            case BusType.USERS:
+                self._send(link, BusType.USERS, fields[0], *self.sorted_names)
+
+            case BusType.ENTER:
+                counts = self.room_counts.setdefault(link.worker, {})
+                counts[fields[0]] = counts.get(fields[0], 0) + 1
+
+            case BusType.LEAVE:
+                counts = self.room_counts.get(link.worker, {})
+                remaining = counts.get(fields[0], 0) - 1
+                if remaining > 0:
+                    counts[fields[0]] = remaining
+                else:
+                    counts.pop(fields[0], None)
+
+            case BusType.ROOMS:
+                listing: list[str] = []
+                for room, count in sorted(self._room_totals().items()):
+                    listing += [room, str(count)]
+                self._send(link, BusType.ROOMS, fields[0], *listing)
+
+    def run(self):
+        while self.links:
+            for key, mask in self.selector.select():
+                link: BusLink = key.data
+                if link.sock.fileno() == -1:
+                    # Dropped for falling behind earlier in this batch.
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    link.flush()
+
+                if mask & selectors.EVENT_READ:
+                    messages = link.read()
+                    if messages is None:
+                        self._worker_lost(link)
+                        continue
+                    for type, fields in messages:
+                        if link.sock.fileno() == -1:
+                            break
+                        try:
+                            self.handle(link, type, fields)
+                        except Exception:
+                            # One malformed message must not stop the hub
+                            # and with it every worker.
+                            log.exception("Bad %s message from worker %d: %r", type.name, link.worker, fields)
+
+
+def fork_workers(count: int, worker_main, high_water: int, slow_policy: str) -> None:
+    """
+    Forks `count` workers, each calling worker_main(index, bus_socket), and
+    runs the hub in this process until every worker has exited.  `high_water`
+    and `slow_policy` bound each worker's backlog on the hub side; see Hub.
+    """
+    hub = Hub(high_water, slow_policy)
+    pids: list[int] = []
+
+    for index in range(count):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for link in hub.links:
+                link.sock.close()
+            hub.selector.close()
+            try:
+                worker_main(index, child_end)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+
+        child_end.close()
+        hub.add_worker(parent_end)
+        pids.append(pid)
+
+    log.info("Started %d workers: %s", count, pids)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        log.info("KeyboardInterrupt, stopping workers...")
+        # A second signal must not interrupt reaping the workers below.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        for pid in pids:
+            os.waitpid(pid, 0)
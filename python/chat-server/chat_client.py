@@ -8,13 +8,41 @@ from chatui import init_windows, read_command, print_message, end_windows
 
 server_socket: socket.socket
 running: bool = True
+# Asked for in HELLO, and switched to once the server's answer echoes them.
+framing: int = FRAMING_V1
+compressor: Compressor | None = None
+# Set once the server has answered our HELLO (or closed the connection).
+# Nothing else is sent before, since we cannot know its framing until then.
+hello_answered: threading.Event = threading.Event()
+# The listener thread answers PINGs while the main thread sends what the
+# user types; frames must not interleave and the compressor is not shared.
+send_lock: threading.Lock = threading.Lock()
+
+
+def send(pkt: Packet):
+    hello_answered.wait()
+    with send_lock:
+        send_packet(server_socket, pkt, framing, compressor)
+
+
+def accept_hello_answer(payload: str):
+    global framing, compressor
+
+    options = split_hello(payload)[1]
+    with send_lock:
+        if FRAMING_V2_OPTION in options:
+            framing = FRAMING_V2
+            if COMPRESS_OPTION in options:
+                compressor = Compressor()
+    hello_answered.set()
+
 
 def listen_server(server: socket.socket):
-    buf = bytearray()
+    reader = PacketReader()
 
     while True:
         try:
-            pkt: Packet | None = receive_packet(server, buf)
+            packets: list[Packet] | None = receive_packets(server, reader)
         except ConnectionResetError:
             print("Server closed connection.")
             break
@@ -22,13 +50,31 @@ def listen_server(server: socket.socket):
             print(f"Error receiving packet: {e}")
             break
 
-        if pkt is None:
-            continue
-
-        print_message(pkt.payload)
+        if packets is None:
+            print_message("Server closed connection.")
+            break
 
-        if pkt.type is PacketType.ABORT:
-            os._exit(1)
+        for pkt in packets:
+            if pkt.type is PacketType.PING:
+                # Before the HELLO answer we cannot reply, and send() would
+                # wait on this very thread.
+                if hello_answered.is_set():
+                    send(Packet(PacketType.PONG, pkt.payload))
+            elif pkt.type is PacketType.PONG:
+                pass
+            elif pkt.type is PacketType.JOIN:
+                print_message(f"*** Now chatting in #{pkt.payload} ***")
+            elif pkt.type is PacketType.HELLO:
+                accept_hello_answer(pkt.payload)
+                print_message(split_hello(pkt.payload)[0])
+            else:
+                print_message(pkt.payload)
+
+            if pkt.type is PacketType.ABORT:
+                os._exit(1)
+
+    # Whatever the main thread sends now fails instead of waiting forever.
+    hello_answered.set()
 
 
 def start_client(username: str, server_addr: str, port: int) -> socket.socket:
@@ -47,15 +93,17 @@ def start_client(username: str, server_addr: str, port: int) -> socket.socket:
     server_thread = threading.Thread(target=listen_server, args=[server_socket], daemon=True)
     server_thread.start()
 
-    pkt: Packet = Packet(PacketType.HELLO, username)
-    send_packet(server_socket, pkt)
+    pkt: Packet = Packet(PacketType.HELLO, hello_payload(username, FRAMING_V2_OPTION, COMPRESS_OPTION))
+    with send_lock:
+        send_packet(server_socket, pkt)
 
     return server_socket
 
 
 def end_client(server: socket.socket):
     goodbye_pkt: Packet = Packet(PacketType.GOODBYE, "")
-    send_packet(server, goodbye_pkt)
+    with send_lock:
+        send_packet(server, goodbye_pkt, framing, compressor)
     end_windows()
     server.close()
 
@@ -66,12 +114,21 @@ def handle_help():
     print_message("/users                : lists all users currently connected.")
     print_message("/me                   : emote command.  ex. /em does a dance -> [user does a dance]")
     print_message("/dm <username> <text> : direct messages <text> to <name>")
+    print_message("/join <room>          : leaves your current room and joins <room>")
+    print_message("/part                 : leaves your current room and returns to the lobby")
+    print_message("/rooms                : lists all rooms and how many users are in each")
+    print_message("/throttled            : lists users the server is rate limiting")
+    print_message("/paste <file>         : sends the contents of <file> as one message (up to 1 MiB)")
     print_message("/q                    : quit the application")
 
 
 def handle_users():
     pkt: Packet = Packet(PacketType.COMMAND, "users")
-    send_packet(server_socket, pkt)
+    send(pkt)
+
+
+def handle_throttled():
+    send(Packet(PacketType.COMMAND, "throttled"))
 
 
 def handle_emote(emote_text: str):
@@ -79,7 +136,7 @@ def handle_emote(emote_text: str):
         return
 
     emote_pkt = Packet(PacketType.EMOTE, emote_text)
-    send_packet(server_socket, emote_pkt)
+    send(emote_pkt)
 
 
 def handle_whisper(command: str):
@@ -97,7 +154,42 @@ def handle_whisper(command: str):
 
     pm_payload = f"{target} {message}"
     pm_pkt = Packet(PacketType.DM, pm_payload)
-    send_packet(server_socket, pm_pkt)
+    send(pm_pkt)
+
+
+def handle_join(room: str):
+    room = room.strip()
+
+    if not room:
+        print_message("usage: /join <room>")
+        return
+
+    send(Packet(PacketType.JOIN, room))
+
+
+def handle_part():
+    send(Packet(PacketType.PART, ""))
+
+
+def handle_rooms():
+    send(Packet(PacketType.LIST, ""))
+
+
+def handle_paste(path: str):
+    path = path.strip()
+
+    if not path:
+        print_message("usage: /paste <file>")
+        return
+
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    except OSError as e:
+        print_message(f"Could not read {path}: {e.strerror}")
+        return
+
+    send(Packet(PacketType.CHAT, text))
 
 
 def handle_quit():
@@ -115,10 +207,20 @@ def handle_non_chat_commands(command: str):
             handle_help()
         case "/users":
             handle_users()
+        case "/throttled":
+            handle_throttled()
         case "/me":
             handle_emote(rest)
         case "/dm":
             handle_whisper(rest)
+        case "/join":
+            handle_join(rest)
+        case "/part":
+            handle_part()
+        case "/rooms":
+            handle_rooms()
+        case "/paste":
+            handle_paste(rest)
         case "/q":
             handle_quit()
         case _:
@@ -128,7 +230,7 @@ def handle_non_chat_commands(command: str):
 def handle_command(command: str):
     if not command.startswith("/"):
         chat_pkt: Packet = Packet(PacketType.CHAT, command)
-        send_packet(server_socket, chat_pkt)
+        send(chat_pkt)
     else:
         handle_non_chat_commands(command)
 
@@ -0,0 +1,202 @@
+"""
+Bounded per-room message history for chat_server.
+
+Each room keeps its most recent CHAT packets exactly as they were broadcast.
+A packet caches its encoded frames, so replaying history to a user who
+joins is a single vectored write of frames that already exist.  Memory is
+bounded three ways: messages per room, payload bytes per room, and the
+number of rooms that keep a history at all (least recently active rooms
+are evicted first).
+
+Optionally every recorded packet is also appended to a log file so history
+survives a restart.  Appends would grow the file forever, so once it is
+LOG_COMPACT_FACTOR times the size it had after its last rewrite, it is
+rewritten from memory: the file stays within a constant factor of the
+history's own bounds, and each rewrite is paid for by the appends before it.
+The rewrite runs on a background thread from a snapshot of the history;
+records appended meanwhile are copied over before the new file replaces
+the old one, so the event loop never waits for the disk.
+Log record structure:
+    Byte1   : Room name length
+    Byte2   : PacketType enum
+    Byte3-6 : Payload Length, 4 byte unsigned big-endian
+    then    : Room name, UTF-8
+    then    : Payload bytes
+"""
+import os
+import mmap
+import struct
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from packet import Packet, PacketType
+
+LOG_HEADER: struct.Struct = struct.Struct(">BBI")
+LOG_COMPACT_FACTOR: int = 4
+# Smaller logs are never rewritten, so a near-empty history does not rewrite
+# on every few messages.
+LOG_COMPACT_MIN: int = 1024 * 1024
+
+
+class RoomHistory:
+    def __init__(self, max_messages: int, max_bytes: int):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.packets: deque[Packet] = deque()
+        self.nbytes = 0
+
+    def append(self, pkt: Packet):
+        self.packets.append(pkt)
+        self.nbytes += len(pkt.payload_bytes)
+
+        while len(self.packets) > self.max_messages or self.nbytes > self.max_bytes:
+            self.nbytes -= len(self.packets.popleft().payload_bytes)
+
+
+class HistoryStore:
+    def __init__(self, max_messages: int, max_bytes: int, max_rooms: int):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_rooms = max_rooms
+        self.rooms: OrderedDict[str, RoomHistory] = OrderedDict()
+        self.log_fd: int | None = None
+        self.log_path: str | None = None
+        # Bytes in the log now, and right after it was last rewritten.
+        self.log_bytes = 0
+        self.log_compacted_bytes = 0
+        # The rewrite in progress, and the records appended since its snapshot.
+        self.log_executor: ThreadPoolExecutor | None = None
+        self.compacting: Future[int] | None = None
+        self.log_pending: list[bytes] = []
+
+    def _room(self, room: str) -> RoomHistory:
+        history = self.rooms.get(room)
+        if history is None:
+            history = RoomHistory(self.max_messages, self.max_bytes)
+            self.rooms[room] = history
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        return history
+
+    def record(self, room: str, pkt: Packet, log: bool = True):
+        if self.max_messages <= 0:
+            return
+
+        self._room(room).append(pkt)
+
+        if log and self.log_fd is not None:
+            data = _log_record(room, pkt)
+            self.log_bytes += os.write(self.log_fd, data)
+            if self.compacting is not None:
+                self.log_pending.append(data)
+                if self.compacting.done():
+                    self._finish_compaction(self.log_fd)
+            elif self.log_bytes > max(LOG_COMPACT_MIN, LOG_COMPACT_FACTOR * self.log_compacted_bytes):
+                self.compact_log()
+
+    def packets(self, room: str) -> list[Packet]:
+        history = self.rooms.get(room)
+        return list(history.packets) if history is not None else []
+
+    def load_log(self, path: str) -> int:
+        """
+        Replays a history log into memory and returns the number of packets
+        read.  The file is memory-mapped rather than read, and a truncated
+        trailing record (from a crash mid-write) is ignored.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+
+        if size == 0:
+            return 0
+
+        count = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + LOG_HEADER.size <= size:
+                room_len, type_byte, payload_len = LOG_HEADER.unpack_from(data, offset)
+                room_start = offset + LOG_HEADER.size
+                payload_start = room_start + room_len
+                record_end = payload_start + payload_len
+                if record_end > size:
+                    break
+
+                room = data[room_start:payload_start].decode()
+                pkt = Packet(PacketType(type_byte), data[payload_start:record_end])
+                self.record(room, pkt, log=False)
+                offset = record_end
+                count += 1
+
+        return count
+
+    def rewrite_log(self, path: str) -> int:
+        """
+        Replaces the log with just the packets currently held in memory, so
+        the file on disk stays within the same bounds as the history itself.
+        Returns the new size of the file.
+        """
+        tmp_path = path + ".tmp"
+        size = _write_log(tmp_path, self._snapshot())
+        os.replace(tmp_path, path)
+        return size
+
+    def open_log(self, path: str):
+        self.log_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.log_path = path
+        self.log_bytes = self.log_compacted_bytes = os.fstat(self.log_fd).st_size
+        self.log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-log")
+
+    def compact_log(self):
+        """
+        Starts rewriting the log on the background thread.  Appends keep going
+        to the current file until a later record() finds the rewrite done.
+        """
+        if self.log_path is None or self.log_executor is None or self.compacting is not None:
+            return
+        self.log_pending = []
+        self.compacting = self.log_executor.submit(_write_log, self.log_path + ".tmp", self._snapshot())
+
+    def _finish_compaction(self, old_fd: int):
+        compacting, self.compacting = self.compacting, None
+        pending, self.log_pending = self.log_pending, []
+        if compacting is None or self.log_path is None:
+            return
+
+        tmp_path = self.log_path + ".tmp"
+        try:
+            size = compacting.result()
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            # Keep appending to the old file; the next record() tries again.
+            return
+
+        compacted = size
+        for data in pending:
+            size += os.write(fd, data)
+        os.replace(tmp_path, self.log_path)
+        os.close(old_fd)
+        self.log_fd = fd
+        self.log_compacted_bytes = compacted
+        self.log_bytes = size
+
+    def _snapshot(self) -> list[tuple[str, Packet]]:
+        # Only references: the packets themselves are never modified.
+        return [(room, pkt) for room, history in self.rooms.items() for pkt in history.packets]
+
+
+def _write_log(path: str, records: list[tuple[str, Packet]]) -> int:
+    size = 0
+    with open(path, "wb") as f:
+        for room, pkt in records:
+            size += f.write(_log_record(room, pkt))
+    return size
+
+
+def _log_record(room: str, pkt: Packet) -> bytes:
+    room_bytes = room.encode()
+    payload_bytes = pkt.payload_bytes
+    return LOG_HEADER.pack(len(room_bytes), pkt.type.value, len(payload_bytes)) + room_bytes + payload_bytes
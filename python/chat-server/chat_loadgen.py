@@ -0,0 +1,313 @@
+# Example usage:
+#
+# python chat_loadgen.py 3490 --clients 1000 --rate 500 --duration 10
+# python chat_loadgen.py 3490 --spawn --mix chat=70,dm=20,emote=10 --max-p99-ms 50
+# python chat_loadgen.py 3490 --spawn --server-args="--workers 4"
+# python chat_loadgen.py 3490 --spawn --framing 2 --text-size 200000
+# python chat_loadgen.py 3490 --spawn --compress --server-args="--compression shared"
+#
+# Headless load generator for chat_server.  Opens --clients connections to a
+# server on localhost, sends HELLO from each, then sends CHAT/DM/EMOTE packets
+# at --rate packets per second for --duration seconds, picking the sender and
+# packet type at random according to --mix.  Clients use v1 framing unless
+# --framing 2 is given; --text-size pads every line to about that many bytes,
+# which with v2 framing can go past the 64 KiB v1 limit.  --compress (implies
+# --framing 2) makes every client ask for compression and deflate what it
+# sends.
+#
+# Every payload carries its send time, so each delivery of it to any client
+# yields one end-to-end latency sample.  At the end the tool prints latency
+# percentiles, packets sent and frames delivered per second, bytes received
+# per delivered frame, and server RSS (when it knows the server's pid).  With --max-p99-ms it exits non-zero if
+# p99 latency is over budget, so it can gate a release.  It also exits
+# non-zero, whatever the latency, if a client was not welcomed, if fewer than
+# --min-delivered of the expected frames arrived (every client gets each
+# CHAT/EMOTE, sender and target each DM), or if ERROR packets plus
+# disconnects exceed --max-errors.
+
+import sys
+import time
+import random
+import socket
+import argparse
+import selectors
+import subprocess
+
+from packet import (Packet, PacketType, PacketReader, Compressor, FRAMING_V1, FRAMING_V2,
+                    FRAMING_V2_OPTION, COMPRESS_OPTION, hello_payload, split_hello)
+from bench_event_loop import raise_fd_limit
+from bench_server_modes import server_rss_kib, start_server
+
+STAMP: str = "@lg:"
+READ_SIZE: int = 256 * 1024
+# All simulated clients are driven from one thread, so they share one
+# recv_into target.
+shared_chunk: bytearray = bytearray(READ_SIZE)
+
+class SimClient:
+    def __init__(self, index: int, sock: socket.socket):
+        self.index = index
+        self.name = f"lg{index}"
+        self.sock = sock
+        self.reader = PacketReader(chunk=shared_chunk)
+        self.outbuf = bytearray()
+        self.welcomed = False
+        self.framing = FRAMING_V1
+        self.compressor: Compressor | None = None
+
+
+def parse_mix(text: str) -> tuple[list[PacketType], list[int]]:
+    names = {"chat": PacketType.CHAT, "dm": PacketType.DM, "emote": PacketType.EMOTE}
+    kinds: list[PacketType] = []
+    weights: list[int] = []
+
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in names:
+            raise argparse.ArgumentTypeError(f"unknown packet kind in --mix: {name}")
+        kinds.append(names[name.strip()])
+        weights.append(int(weight or "1"))
+
+    return kinds, weights
+
+
+def percentile(sorted_samples: list[int], pct: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, int(len(sorted_samples) * pct / 100))
+    return sorted_samples[idx] / 1e6
+
+
+class LoadGen:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.sel = selectors.DefaultSelector()
+        self.clients: list[SimClient] = []
+        self.latencies_ns: list[int] = []
+        self.sent = 0
+        # Frames the sends should produce if everything is delivered.
+        self.expected = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.bytes_received = 0
+        self.dm_target: SimClient | None = None
+
+    def connect(self):
+        for i in range(self.args.clients):
+            sock = socket.create_connection((self.args.host, self.args.port))
+            sock.setblocking(False)
+            client = SimClient(i, sock)
+            self.sel.register(sock, selectors.EVENT_READ, data=client)
+            self.clients.append(client)
+            # Framing and compression switch in read(), once the server's
+            # answer confirms them; nothing else is sent before that.
+            self.send(client, Packet(PacketType.HELLO, hello_payload(client.name, *self.hello_options())))
+            self.pump(0)
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not all(c.welcomed for c in self.clients):
+            self.pump(0.1)
+
+    def hello_options(self) -> list[str]:
+        options: list[str] = []
+        if self.args.framing == FRAMING_V2:
+            options.append(FRAMING_V2_OPTION)
+        if self.args.compress:
+            options.append(COMPRESS_OPTION)
+        return options
+
+    def send(self, client: SimClient, pkt: Packet):
+        frames = client.compressor.frames(pkt) if client.compressor else pkt.frames(client.framing)
+        for frame in frames:
+            client.outbuf += frame
+        self.flush(client)
+
+    def flush(self, client: SimClient):
+        try:
+            sent = client.sock.send(client.outbuf)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return
+        del client.outbuf[:sent]
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        if self.sel.get_key(client.sock).events != events:
+            self.sel.modify(client.sock, events, data=client)
+
+    def pump(self, timeout: float):
+        for key, mask in self.sel.select(timeout):
+            client: SimClient = key.data
+
+            if mask & selectors.EVENT_WRITE:
+                self.flush(client)
+
+            if mask & selectors.EVENT_READ:
+                self.read(client)
+
+    def read(self, client: SimClient):
+        try:
+            nbytes = client.sock.recv_into(client.reader.chunk)
+        except BlockingIOError:
+            return
+        except OSError:
+            nbytes = 0
+
+        if nbytes == 0:
+            self.disconnects += 1
+            self.sel.unregister(client.sock)
+            return
+
+        self.bytes_received += nbytes
+        now = time.perf_counter_ns()
+        for pkt in client.reader.feed(client.reader.chunk[:nbytes]):
+            match pkt.type:
+                case PacketType.HELLO:
+                    options = split_hello(pkt.payload)[1]
+                    if FRAMING_V2_OPTION in options:
+                        client.framing = FRAMING_V2
+                        if COMPRESS_OPTION in options:
+                            client.compressor = Compressor()
+                    client.welcomed = True
+                case PacketType.ERROR:
+                    self.errors += 1
+                case PacketType.PING if client.welcomed:
+                    self.send(client, Packet(PacketType.PONG, pkt.payload))
+                case PacketType.CHAT:
+                    text = pkt.payload
+                    idx = text.rfind(STAMP)
+                    if idx != -1:
+                        end = idx + len(STAMP)
+                        while end < len(text) and text[end].isdigit():
+                            end += 1
+                        self.latencies_ns.append(now - int(text[idx+len(STAMP):end]))
+
+    def make_packet(self, sender: SimClient, kind: PacketType) -> Packet:
+        stamp = f"{STAMP}{time.perf_counter_ns()}"
+        if kind is PacketType.DM:
+            target = random.choice(self.clients)
+            self.dm_target = target
+            return Packet(PacketType.DM, f"{target.name} {self.args.text} {stamp}")
+        return Packet(kind, f"{self.args.text} {stamp}")
+
+    def deliveries(self, sender: SimClient, kind: PacketType) -> int:
+        if kind is PacketType.DM:
+            # A DM to oneself is counted once, the least it can produce.
+            return 1 if self.dm_target is sender else 2
+        return len(self.clients)
+
+    def run(self):
+        kinds, weights = self.args.mix
+        interval = 1.0 / self.args.rate
+        start = time.perf_counter()
+        next_send = start
+        end = start + self.args.duration
+
+        while (now := time.perf_counter()) < end:
+            while next_send <= now:
+                sender = random.choice(self.clients)
+                kind = random.choices(kinds, weights)[0]
+                self.send(sender, self.make_packet(sender, kind))
+                self.sent += 1
+                self.expected += self.deliveries(sender, kind)
+                next_send += interval
+            self.pump(max(0.0, min(next_send, end) - time.perf_counter()))
+
+        sending = time.perf_counter() - start
+
+        # Give in-flight frames a moment to arrive.
+        drain_until = time.perf_counter() + self.args.drain
+        while time.perf_counter() < drain_until:
+            self.pump(0.05)
+
+        return sending, time.perf_counter() - start
+
+    def close(self):
+        for client in self.clients:
+            client.sock.close()
+        self.sel.close()
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="chat_loadgen.py")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=200.0, help="packets sent per second, all clients combined")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to keep reading after sending stops")
+    parser.add_argument("--mix", type=parse_mix, default="chat=80,dm=10,emote=10")
+    parser.add_argument("--text", default="the quick brown fox jumps over the lazy dog")
+    parser.add_argument("--text-size", type=int, default=0, help="pad --text to this many bytes")
+    parser.add_argument("--framing", type=int, choices=[1, 2], default=FRAMING_V1)
+    parser.add_argument("--compress", action="store_true", help="ask for compression and compress what is sent")
+    parser.add_argument("--spawn", action="store_true", help="start chat_server.py on --port for the run")
+    parser.add_argument("--server-args", default="", help="extra arguments for a --spawn'ed server")
+    parser.add_argument("--server-pid", type=int,
+                        help="pid of an already running server, for RSS (the hub process under --workers)")
+    parser.add_argument("--max-p99-ms", type=float, help="exit with status 1 if p99 latency exceeds this")
+    parser.add_argument("--min-delivered", type=float, default=0.99,
+                        help="exit with status 1 if fewer than this fraction of expected frames arrive")
+    parser.add_argument("--max-errors", type=int, default=0,
+                        help="exit with status 1 if ERROR packets plus disconnects exceed this")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv: list[str]):
+    args = parse_args(argv)
+    if args.compress:
+        args.framing = FRAMING_V2
+    if len(args.text) < args.text_size:
+        args.text = (args.text + " ") * (args.text_size // (len(args.text) + 1) + 1)
+        args.text = args.text[:args.text_size]
+    raise_fd_limit(args.clients + 64)
+
+    server: subprocess.Popen | None = None
+    if args.spawn:
+        server = start_server(args.port, args.server_args.split())
+        args.server_pid = server.pid
+
+    gen = LoadGen(args)
+    try:
+        gen.connect()
+        rss_idle = server_rss_kib(args.server_pid) if args.server_pid else 0
+        sending, elapsed = gen.run()
+        rss_loaded = server_rss_kib(args.server_pid) if args.server_pid else 0
+    finally:
+        gen.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    samples = sorted(gen.latencies_ns)
+    p50, p90, p99 = (percentile(samples, p) for p in (50, 90, 99))
+
+    welcomed = sum(c.welcomed for c in gen.clients)
+
+    print(f"clients        : {args.clients} ({welcomed} welcomed)")
+    print(f"sent           : {gen.sent} packets, {gen.sent / sending:,.0f}/s")
+    print(f"delivered      : {len(samples)} frames of {gen.expected} expected, {len(samples) / elapsed:,.0f}/s")
+    print(f"received       : {gen.bytes_received:,} bytes, {gen.bytes_received / max(1, len(samples)):,.1f} per frame")
+    print(f"latency (ms)   : p50 {p50:.2f}  p90 {p90:.2f}  p99 {p99:.2f}  max {percentile(samples, 100):.2f}")
+    print(f"errors         : {gen.errors} ERROR packets, {gen.disconnects} disconnects")
+    if args.server_pid:
+        print(f"server rss     : {rss_idle:,} KiB idle, {rss_loaded:,} KiB under load")
+
+    failures: list[str] = []
+    if welcomed < args.clients:
+        failures.append(f"only {welcomed} of {args.clients} clients were welcomed")
+    if not samples:
+        failures.append("no frames were delivered")
+    elif len(samples) < gen.expected * args.min_delivered:
+        failures.append(f"{len(samples)} frames delivered, under {args.min_delivered:.0%} of {gen.expected} expected")
+    if gen.errors + gen.disconnects > args.max_errors:
+        failures.append(f"{gen.errors} ERROR packets and {gen.disconnects} disconnects exceed {args.max_errors}")
+    if args.max_p99_ms is not None and samples and p99 > args.max_p99_ms:
+        failures.append(f"p99 {p99:.2f} ms exceeds {args.max_p99_ms} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
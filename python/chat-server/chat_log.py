@@ -0,0 +1,64 @@
+"""
+Logging setup for chat_server.
+
+Records go through the standard logging module at four levels: per-message
+detail is DEBUG, connection lifecycle INFO, misbehaving clients WARNING, and
+failures ERROR.  A filter on the handler caps the output at a number of
+lines per second; what it holds back is counted and reported on the next
+line that gets through, so a flood cannot turn logging into the bottleneck.
+"""
+import sys
+import logging
+
+from chat_ratelimit import TokenBucket
+
+log: logging.Logger = logging.getLogger("chat_server")
+
+LEVELS: dict[str, int] = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "off": logging.CRITICAL + 1,
+}
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, lines_per_second: float):
+        super().__init__()
+        self.bucket = TokenBucket(lines_per_second, max(1.0, lines_per_second), 0.0)
+        self.suppressed = 0
+        self.total_suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.bucket.take(record.created):
+            self.suppressed += 1
+            self.total_suppressed += 1
+            return False
+
+        if self.suppressed:
+            record.msg = f"{record.getMessage()} ({self.suppressed} lines suppressed)"
+            record.args = None
+            self.suppressed = 0
+        return True
+
+
+def setup_logging(level: str, lines_per_second: float, prefix: str = "") -> RateLimitFilter | None:
+    """
+    Configures `log`.  Returns the rate-limit filter, whose
+    `total_suppressed` count is worth exposing, or None if output is not rate limited.
+    """
+    log.handlers.clear()
+    log.propagate = False
+    log.setLevel(LEVELS[level])
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s {prefix}%(message)s"))
+    log.addHandler(handler)
+
+    if lines_per_second <= 0:
+        return None
+
+    rate_filter = RateLimitFilter(lines_per_second)
+    handler.addFilter(rate_filter)
+    return rate_filter
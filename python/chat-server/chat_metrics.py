@@ -0,0 +1,241 @@
+"""
+Counters and histograms for chat_server, served as Prometheus-style text.
+
+Recording is a list index and an integer add, cheap enough for the hot path.
+Histograms use fixed power-of-two microsecond buckets, so observing a value
+is a bit_length() rather than a search.  Gauges (connected users, queued
+bytes, ...) are not tracked continuously; the server computes them when the
+endpoint is scraped.
+
+The endpoint is a minimal HTTP/1.0 responder on a local port: any GET gets
+the current text exposition and the connection is closed.  It is driven by
+the server's own event loop, selectors or asyncio.  A scrape that has not
+sent its request within REQUEST_TIMEOUT seconds is dropped.
+"""
+import time
+import errno
+import socket
+import asyncio
+import selectors
+from collections.abc import Callable
+from typing import Any
+
+from packet import PacketType
+from chat_log import log
+
+# Upper bounds, in microseconds, of the histogram buckets: 1us .. ~1s.
+BUCKET_BOUNDS_US: list[int] = [1 << i for i in range(21)]
+MAX_REQUEST: int = 8192
+REQUEST_TIMEOUT: float = 5.0
+# Like the chat listener, the metrics listener is left out of select() for
+# ACCEPT_BACKOFF seconds when accept() fails for lack of descriptors or
+# memory, instead of waking the loop on every iteration.
+ACCEPT_BACKOFF: float = 0.5
+ACCEPT_EXHAUSTED: set[int] = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM}
+
+# Schedules callback(argument) on the selectors loop at a time.monotonic() deadline.
+CallAt = Callable[[float, Callable[[Any], None], Any], None]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum_ns", "count")
+
+    def __init__(self):
+        # One slot per bound plus the overflow (+Inf) bucket.
+        self.counts = [0] * (len(BUCKET_BOUNDS_US) + 1)
+        self.sum_ns = 0
+        self.count = 0
+
+    def observe_ns(self, ns: int):
+        # Bucket i holds values up to 2**i us.
+        us = (ns + 999) // 1000
+        index = (us - 1).bit_length() if us else 0
+        counts = self.counts
+        counts[index if index < len(counts) else -1] += 1
+        self.sum_ns += ns
+        self.count += 1
+
+    def render(self, name: str, help: str) -> list[str]:
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS_US, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound / 1e6:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum_ns / 1e9:.9f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        # Indexed by PacketType value.
+        self.packets_in = [0] * len(PacketType)
+        self.packets_out = [0] * len(PacketType)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.slow_drops = 0
+        self.slow_disconnects = 0
+        self.throttled = 0
+        self.idle_disconnects = 0
+        self.loop_iteration = Histogram()
+        self.loop_lag = Histogram()
+        self.handle_packet = Histogram()
+
+    def render(self, gauges: dict[str, tuple[str, float]]) -> str:
+        """
+        `gauges` maps metric name to (help text, current value).
+        """
+        lines: list[str] = []
+
+        for name, help, values in (
+                ("chat_packets_in_total", "Packets received, by type.", self.packets_in),
+                ("chat_packets_out_total", "Packets queued for sending, by type.", self.packets_out)):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+            for type in PacketType:
+                lines.append(f'{name}{{type="{type.name}"}} {values[type.value]}')
+
+        for name, help, value in (
+                ("chat_bytes_in_total", "Bytes read from clients.", self.bytes_in),
+                ("chat_bytes_out_total", "Bytes written to clients.", self.bytes_out),
+                ("chat_connections_total", "Connections accepted.", self.connections),
+                ("chat_slow_consumer_drops_total", "Messages dropped for users over the high-water mark.",
+                 self.slow_drops),
+                ("chat_slow_consumer_disconnects_total", "Users disconnected for exceeding the high-water mark.",
+                 self.slow_disconnects),
+                ("chat_throttled_packets_total", "Packets dropped by per-user rate limits.", self.throttled),
+                ("chat_idle_disconnects_total", "Connections closed after --idle-timeout of silence.",
+                 self.idle_disconnects)):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} counter", f"{name} {value}"]
+
+        lines += self.loop_iteration.render(
+            "chat_loop_iteration_seconds", "Time spent handling the events of one selectors loop wakeup.")
+        lines += self.loop_lag.render(
+            "chat_loop_lag_seconds", "How late a 100 ms timer fires on the asyncio loop.")
+        lines += self.handle_packet.render(
+            "chat_handle_packet_seconds", "Time spent in handle_packet per packet.")
+
+        for name, (help, value) in gauges.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+
+        return "\n".join(lines) + "\n"
+
+
+def _http_response(body: str) -> bytes:
+    data = body.encode()
+    header = ("HTTP/1.0 200 OK\r\n"
+              "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+              f"Content-Length: {len(data)}\r\n"
+              "Connection: close\r\n\r\n")
+    return header.encode() + data
+
+
+class MetricsRequest:
+    """
+    One scrape connection on the selectors loop: read until the end of the
+    request headers, write the response, close.
+    """
+    def __init__(self, endpoint: 'MetricsEndpoint', sock: socket.socket):
+        self.endpoint = endpoint
+        self.sock = sock
+        self.request = bytearray()
+        self.response: memoryview | None = None
+        self.closed = False
+
+    def handle_event(self, mask: int):
+        if self.response is None and mask & selectors.EVENT_READ:
+            try:
+                data = self.sock.recv(MAX_REQUEST)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+
+            self.request += data
+            if not data or len(self.request) > MAX_REQUEST:
+                self.close()
+                return
+            if b"\r\n\r\n" not in self.request and b"\n\n" not in self.request:
+                return
+
+            self.response = memoryview(_http_response(self.endpoint.render()))
+            self.endpoint.selector.modify(self.sock, selectors.EVENT_WRITE, data=self)
+
+        if self.response is not None:
+            try:
+                sent = self.sock.send(self.response)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            self.response = self.response[sent:]
+            if not self.response:
+                self.close()
+
+    def close(self):
+        # Also the request's deadline timer, which still fires after a
+        # normal close.
+        if self.closed:
+            return
+        self.closed = True
+        self.endpoint.selector.unregister(self.sock)
+        self.sock.close()
+
+
+class MetricsEndpoint:
+    """
+    Listens on 127.0.0.1:`port` and answers every request with render().
+    """
+    # Set by register(), for the selectors loop only.
+    selector: selectors.BaseSelector
+    listener: socket.socket
+    call_at: CallAt
+
+    def __init__(self, port: int, render: Callable[[], str]):
+        self.port = port
+        self.render = render
+
+    def register(self, selector: selectors.BaseSelector, call_at: CallAt):
+        self.selector = selector
+        self.call_at = call_at
+        self.listener = socket.create_server(("127.0.0.1", self.port))
+        self.listener.setblocking(False)
+        selector.register(self.listener, selectors.EVENT_READ, data=self)
+
+    def handle_event(self, mask: int):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno in ACCEPT_EXHAUSTED:
+                log.warning("Cannot accept metrics connections: %s.  Pausing for %.1f s.",
+                            e.strerror, ACCEPT_BACKOFF)
+                self.selector.unregister(self.listener)
+                self.call_at(time.monotonic() + ACCEPT_BACKOFF, MetricsEndpoint._resume_accepting, self)
+            # Otherwise the client gave up before we got to it.
+            return
+
+        sock.setblocking(False)
+        request = MetricsRequest(self, sock)
+        self.selector.register(sock, selectors.EVENT_READ, data=request)
+        self.call_at(time.monotonic() + REQUEST_TIMEOUT, MetricsRequest.close, request)
+
+    def _resume_accepting(self):
+        self.selector.register(self.listener, selectors.EVENT_READ, data=self)
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async with asyncio.timeout(REQUEST_TIMEOUT):
+                await reader.readuntil(b"\r\n\r\n")
+            writer.write(_http_response(self.render()))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_asyncio(self) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._serve_client, "127.0.0.1", self.port, limit=MAX_REQUEST)
@@ -0,0 +1,103 @@
+"""
+Per-user flood control for chat_server.
+
+Every user has one token bucket per rate-limited PacketType.  A bucket holds
+at most `burst` tokens and refills at `rate` tokens per second; each packet
+of that type takes a token, and a packet that finds its bucket empty is
+dropped before the server does any work for it, broadcasts included.
+
+Limits are given as TYPE=RATE/BURST, e.g. "chat=5/20", or TYPE=off.
+"""
+import argparse
+
+from packet import PacketType
+
+# (refill per second, burst) per PacketType.  HELLO, GOODBYE and ERROR are
+# never limited.
+DEFAULT_LIMITS: dict[PacketType, tuple[float, float]] = {
+    PacketType.CHAT:    (5.0, 20.0),
+    PacketType.EMOTE:   (2.0, 5.0),
+    PacketType.DM:      (5.0, 20.0),
+    PacketType.COMMAND: (1.0, 5.0),
+    PacketType.JOIN:    (1.0, 5.0),
+    PacketType.PART:    (1.0, 5.0),
+    PacketType.LIST:    (1.0, 5.0),
+    PacketType.PING:    (1.0, 5.0),
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float) -> bool:
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+
+class RateLimiter:
+    """
+    One user's buckets, created on the first packet of each type, and the
+    count of packets dropped per type.  `throttled` is set from the first
+    drop until a limited packet gets through again, so the user is told
+    once per burst of drops rather than once per packet.
+    """
+    __slots__ = ("limits", "buckets", "dropped", "throttled")
+
+    def __init__(self, limits: dict[PacketType, tuple[float, float]]):
+        self.limits = limits
+        self.buckets: dict[PacketType, TokenBucket] = {}
+        self.dropped: dict[PacketType, int] = {}
+        self.throttled = False
+
+    def allow(self, type: PacketType, now: float) -> bool:
+        bucket = self.buckets.get(type)
+        if bucket is None:
+            limit = self.limits.get(type)
+            if limit is None:
+                return True
+            bucket = self.buckets[type] = TokenBucket(limit[0], limit[1], now)
+
+        if bucket.take(now):
+            self.throttled = False
+            return True
+
+        self.dropped[type] = self.dropped.get(type, 0) + 1
+        return False
+
+    def total_dropped(self) -> int:
+        return sum(self.dropped.values())
+
+
+def parse_limit(text: str) -> tuple[PacketType, tuple[float, float] | None]:
+    name, _, spec = text.partition("=")
+    try:
+        type = PacketType[name.strip().upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"unknown packet type: {name}")
+
+    if type not in DEFAULT_LIMITS:
+        raise argparse.ArgumentTypeError(f"{type.name} packets cannot be rate limited")
+
+    if spec.strip().lower() == "off":
+        return type, None
+
+    rate, _, burst = spec.partition("/")
+    try:
+        limit = (float(rate), float(burst or rate))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected TYPE=RATE/BURST or TYPE=off, got {text}")
+
+    if limit[0] <= 0 or limit[1] < 1:
+        raise argparse.ArgumentTypeError(f"rate must be positive and burst at least 1: {text}")
+    return type, limit
@@ -1,13 +1,67 @@
+import os
 import sys
+import time
+import errno
+import heapq
 import socket
-import select
+import bisect
+import itertools
+import asyncio
+import argparse
+import selectors
+from collections import deque
+from collections.abc import Callable, Iterator
+from itertools import islice
+from typing import Any
 from packet import *
+from chat_bus import BusLink, BusType, fork_workers
+from chat_history import HistoryStore
+from chat_ratelimit import RateLimiter, DEFAULT_LIMITS, parse_limit
+from chat_metrics import Metrics, MetricsEndpoint
+from chat_log import log, setup_logging, LEVELS, RateLimitFilter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    IOV_MAX: int = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 class User:
-    def __init__(self, sock: socket.socket, username: str | None = None):
+    def __init__(self, sock: socket.socket, username: str | None = None, chunk: bytearray | None = None):
         self.sock = sock
+        # Cached because fileno() returns -1 once the socket is closed.
+        self.fd = sock.fileno()
         self.username = username
-        self.byte_buffer = bytearray()
+        # Name this user asked for while the hub decides whether it is free.
+        self.pending_name: str | None = None
+        self.room: str | None = None
+        self.limiter = RateLimiter(rate_limits)
+        # Compressed frames are refused until _accept_hello agrees to them.
+        self.reader = PacketReader(chunk=chunk, max_message=max_message, accept_compressed=False)
+        # Framing used for what we send.  Switched to v2 once the user's
+        # HELLO asked for it and has been answered.
+        self.framing = FRAMING_V1
+        # Set once the user's HELLO asked for compression and we agreed.
+        self.compressor: Compressor | None = None
+        # Frames accepted for this user but not yet taken by the kernel.  Broadcast
+        # frames are shared by reference between every recipient's queue.
+        self.outq: deque[bytes | memoryview] = deque()
+        # Messages split into several frames, waiting to be moved into outq
+        # one frame at a time; see queue_chunks.
+        self.bulk: deque[Iterator[bytes]] = deque()
+        self.out_bytes = 0
+        self.dropped_messages = 0
+        self.closing = False
+        # Set instead of using outq when the user is served by the asyncio loop.
+        self.transport: asyncio.Transport | None = None
+        self.write_paused = False
+        # When we last read anything from the user, and last sent them a PING.
+        self.last_seen = time.monotonic()
+        self.ping_sent = 0.0
 
     def __repr__(self):
         try:
@@ -17,103 +71,712 @@ class User:
         return f"User(username={self.username!r}, sock={peer})"
 
 listener: socket.socket
-active_users: set[User] = set()
+# One recv_into target shared by every connection; see PacketReader.
+recv_chunk: bytearray = bytearray(DEFAULT_READ_SIZE)
+# Outbound backlog (bytes) a user may build up before slow_policy applies:
+# "disconnect" drops the connection, "drop" discards the new message.
+high_water: int = 256 * 1024
+slow_policy: str = "disconnect"
+# Largest message a v2 client may send; v1 frames cannot exceed MAX_PAYLOAD.
+max_message: int = DEFAULT_MAX_MESSAGE
+# Compression offered to v2 clients that ask for it.  "stream" deflates
+# everything through each user's own Compressor; "shared" does that only for
+# what is sent to one user, and deflates broadcasts once against the preset
+# dictionary so every recipient gets the same bytes.
+compression: str = "off"
+# (refill per second, burst) per PacketType, enforced per user in handle_packet.
+rate_limits: dict[PacketType, tuple[float, float]] = dict(DEFAULT_LIMITS)
+# A user silent for `heartbeat` seconds is sent a PING; one silent for
+# `idle_timeout` seconds is disconnected.  Anything read counts as activity,
+# so only idle connections are ever pinged.  0 disables both.
+heartbeat: float = 30.0
+idle_timeout: float = 90.0
+# The selectors loop's timers, a heap of (deadline, seq, callback, argument),
+# the argument being a User, a metrics scrape, or a listener whose accepting
+# is paused.
+# Every connection has one entry at a time, pushed again when it fires, so a
+# loop iteration only touches the users whose deadline has passed.  Entries
+# of closed connections are not removed; they are skipped when they come due.
+timers: list[tuple[float, int, Callable[[Any], None], Any]] = []
+_timer_seq = itertools.count()
+selector: selectors.BaseSelector = selectors.DefaultSelector()
+# Seconds the listener is left out of select() after accept() runs out of
+# file descriptors, instead of waking the loop for it on every iteration.
+ACCEPT_BACKOFF: float = 0.5
+# accept() errors that mean the process or system is out of resources.
+ACCEPT_EXHAUSTED: set[int] = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM}
+# Link to the hub process when running as one of several --workers.  The
+# indexes below then only cover this worker's users; anything that needs the
+# global picture (name claims, remote DMs, /users) goes through the hub.
+bus: BusLink | None = None
 
-def find_user_by_socket(sock: socket.socket) -> User | None:
-    for user in active_users:
-        if user.sock is sock:
-            return user
-    return None
+# Indexes over the connected users.  users_by_fd holds every connection,
+# users_by_name and sorted_names only those that completed HELLO.  Names are
+# keyed case-folded, so "alice" and "Alice" count as the same user.
+users_by_fd: dict[int, User] = {}
+users_by_name: dict[str, User] = {}
+sorted_names: list[str] = []
+
+# room -> members.  Users enter DEFAULT_ROOM on HELLO and are in exactly one
+# room at a time; chat and emotes only go to the sender's room.
+DEFAULT_ROOM: str = "lobby"
+MAX_ROOM_NAME: int = 32
+rooms: dict[str, set[User]] = {}
+
+# Recent CHAT frames per room, replayed to users as they enter the room.
+history: HistoryStore = HistoryStore(max_messages=50, max_bytes=256 * 1024, max_rooms=256)
+
+metrics: Metrics = Metrics()
+# Serves metrics over HTTP when --metrics-port is given.
+metrics_endpoint: MetricsEndpoint | None = None
+log_filter: RateLimitFilter | None = None
 
 
 def find_user_by_name(name: str) -> User | None:
     if not name:
         return None
-    for u in active_users:
-        if u.username == name:
-            return u
+    return users_by_name.get(name.casefold())
+
+
+def add_user(user: User):
+    users_by_fd[user.fd] = user
+
+
+def set_username(user: User, name: str):
+    user.username = name
+    users_by_name[name.casefold()] = user
+    bisect.insort(sorted_names, name, key=str.casefold)
+
+
+def remove_user(user: User):
+    # The fd may already belong to a newer connection by the time a closed
+    # one is cleaned up, so only drop entries that still point at this user.
+    if users_by_fd.get(user.fd) is user:
+        del users_by_fd[user.fd]
+
+    leave_room(user)
+
+    if user.username is None:
+        return
+
+    key = user.username.casefold()
+    if users_by_name.get(key) is not user:
+        return
+
+    del users_by_name[key]
+    idx = bisect.bisect_left(sorted_names, key, key=str.casefold)
+    del sorted_names[idx]
+
+    if bus is not None:
+        bus.send(BusType.RELEASE, user.username)
+
+
+def normalize_room(name: str) -> str | None:
+    room = name.strip().lstrip("#").casefold()
+    if not room or len(room) > MAX_ROOM_NAME or not room.isprintable() or " " in room:
+        return None
+    return room
+
+
+def enter_room(user: User, room: str):
+    rooms.setdefault(room, set()).add(user)
+    user.room = room
+    if bus is not None:
+        bus.send(BusType.ENTER, room)
+
+
+def leave_room(user: User):
+    room = user.room
+    if room is None:
+        return
+
+    members = rooms.get(room)
+    if members is not None:
+        members.discard(user)
+        if not members:
+            del rooms[room]
+
+    user.room = None
+    if bus is not None:
+        bus.send(BusType.LEAVE, room)
+
+
+def _set_write_interest(user: User, enabled: bool):
+    events = selectors.EVENT_WRITE if user.closing else selectors.EVENT_READ
+    if enabled:
+        events |= selectors.EVENT_WRITE
+    selector.modify(user.sock, events, data=user)
+
+
+def _over_high_water(user: User, nbytes: int, messages: int = 1) -> bool:
+    """
+    Applies slow_policy if queuing `nbytes` more would take the user's
+    backlog over high_water, and returns True if the data must not be
+    queued.  A user with nothing queued accepts one message of any size.
+    """
+    backlog = user.out_bytes
+    if user.transport is not None and user.write_paused:
+        # The transport buffers on its own; pause_writing tells us it is
+        # behind, and only then does its buffer count as backlog.
+        backlog += user.transport.get_write_buffer_size()
+
+    if not backlog or backlog + nbytes <= high_water:
+        return False
+
+    if slow_policy == "drop":
+        user.dropped_messages += messages
+        metrics.slow_drops += messages
+        return True
+    log.warning("%s exceeded the outbound high-water mark, disconnecting.", user)
+    metrics.slow_disconnects += 1
+    disconnect_user(user)
+    return True
+
+
+def queue_bytes(user: User, data: bytes | memoryview):
+    """
+    Never blocks the event loop.  Data goes straight to the socket when the
+    user has no backlog; whatever the kernel does not take is buffered and
+    written by flush_outbound once the socket is write-ready.
+    """
+    transport = user.transport
+    if transport is not None:
+        _queue_on_transport(user, transport, data)
+        return
+
+    if user.closing or user.sock.fileno() == -1:
+        return
+
+    if _over_high_water(user, len(data)):
+        return
+
+    if user.outq:
+        user.outq.append(data)
+        user.out_bytes += len(data)
+        return
+
+    try:
+        sent = user.sock.send(data)
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        disconnect_user(user)
+        return
+
+    metrics.bytes_out += sent
+    if sent < len(data):
+        rest = memoryview(data)[sent:]
+        user.outq.append(rest)
+        user.out_bytes += len(rest)
+        _set_write_interest(user, True)
+
+
+def queue_frames(user: User, frames: list[bytes]):
+    """
+    Queues several frames at once and hands them to the kernel in one
+    vectored write, e.g. when replaying room history.
+    """
+    transport = user.transport
+    if transport is not None:
+        for frame in frames:
+            _queue_on_transport(user, transport, frame)
+        return
+
+    if user.closing or user.sock.fileno() == -1:
+        return
+
+    total = sum(len(frame) for frame in frames)
+    if _over_high_water(user, total, len(frames)):
+        return
+
+    had_backlog = bool(user.outq)
+    user.outq.extend(frames)
+    user.out_bytes += total
+
+    if had_backlog or not _write_queued(user):
+        return
+
+    if user.outq:
+        _set_write_interest(user, True)
+
+
+def queue_chunks(user: User, frames: list[bytes]):
+    """
+    Queues a message that was split into several frames.  The frames wait in
+    user.bulk and are moved into outq one at a time, each only once outq has
+    been written out, so anything queued meanwhile goes out after at most
+    one chunk instead of after the whole message.
+    """
+    transport = user.transport
+    if user.closing or (transport is None and user.sock.fileno() == -1):
+        return
+
+    total = sum(len(frame) for frame in frames)
+    if _over_high_water(user, total):
+        return
+
+    user.bulk.append(iter(frames))
+    user.out_bytes += total
+
+    if transport is not None:
+        _pump_transport(user, transport)
+        return
+
+    # A non-empty outq means a write is already pending and bulk will be
+    # drained from there.
+    if user.outq or not _write_queued(user):
+        return
+
+    if user.outq:
+        _set_write_interest(user, True)
+
+
+def _next_chunk(user: User) -> bytes | None:
+    bulk = user.bulk
+    while bulk:
+        frame = next(bulk[0], None)
+        if frame is not None:
+            return frame
+        bulk.popleft()
     return None
 
 
+def _queue_on_transport(user: User, transport: asyncio.Transport, data: bytes | memoryview):
+    if transport.is_closing():
+        return
+
+    if _over_high_water(user, len(data)):
+        return
+
+    metrics.bytes_out += len(data)
+    transport.write(data)
+
+
+def _pump_transport(user: User, transport: asyncio.Transport):
+    # Chunks are only handed over while the transport is not paused, so
+    # frames written in between still overtake most of a large message.
+    while not user.write_paused and not transport.is_closing():
+        frame = _next_chunk(user)
+        if frame is None:
+            return
+        user.out_bytes -= len(frame)
+        metrics.bytes_out += len(frame)
+        transport.write(frame)
+
+
+def _send_queued(sock: socket.socket, outq: deque[bytes | memoryview]) -> int:
+    if len(outq) == 1:
+        return sock.send(outq[0])
+    # One vectored write for the whole backlog instead of joining the frames.
+    return sock.sendmsg(list(islice(outq, IOV_MAX)))
+
+
+def _write_queued(user: User) -> bool:
+    """
+    Writes as much of the backlog as the kernel takes, refilling outq from
+    user.bulk whenever it runs dry.  Returns False if the user was
+    disconnected.  outq is only left empty once bulk is empty too.
+    """
+    outq = user.outq
+    while True:
+        if not outq:
+            frame = _next_chunk(user)
+            if frame is None:
+                return True
+            outq.append(frame)
+
+        try:
+            sent = _send_queued(user.sock, outq)
+        except BlockingIOError:
+            return True
+        except OSError:
+            disconnect_user(user)
+            return False
+
+        user.out_bytes -= sent
+        metrics.bytes_out += sent
+        while sent:
+            head = outq[0]
+            if sent < len(head):
+                outq[0] = memoryview(head)[sent:]
+                break
+            sent -= len(head)
+            outq.popleft()
+
+        if outq:
+            return True
+
+
+def flush_outbound(user: User):
+    if not _write_queued(user) or user.outq:
+        return
+
+    if user.closing:
+        disconnect_user(user)
+    else:
+        _set_write_interest(user, False)
+
+
+def send_to(user: User, pkt: Packet, shared: bool = False):
+    compressor = user.compressor
+    if compressor is None:
+        frames = pkt.frames(user.framing)
+    elif shared:
+        frames = pkt.shared_frames()
+    else:
+        # Once the compressor has seen a message the peer has to get it, so
+        # slow_policy is applied here, with room for the worst-case growth,
+        # rather than after compressing.
+        if _over_high_water(user, len(pkt.payload_bytes) + STREAM_SLACK):
+            return
+        frames = compressor.frames(pkt)
+
+    metrics.packets_out[pkt.type.value] += 1
+    if len(frames) == 1:
+        queue_bytes(user, frames[0])
+    else:
+        queue_chunks(user, frames)
+
+
 def send_error_to(user: User, message: str):
-    send_packet(user.sock, Packet(PacketType.ERROR, message))
+    send_to(user, Packet(PacketType.ERROR, message))
+
 
+def _broadcast_text(room: str, text: str, exclude: User | None = None, record: bool = False):
+    _broadcast_local(room, text, exclude, record)
+    if bus is not None:
+        bus.send(BusType.BROADCAST, room, text, "1" if record else "0")
 
-def _broadcast_text(text: str, exclude: User | None = None):
+
+def _broadcast_local(room: str, text: str, exclude: User | None = None, record: bool = False):
+    # Serialized once per framing version; every member of the room queues
+    # the same bytes objects, and the room history keeps the packet too.
     pkt = Packet(PacketType.CHAT, text)
-    for user in active_users:
+    if record:
+        history.record(room, pkt)
+    frames_for = pkt.frames
+    shared = compression == "shared"
+    members = list(rooms.get(room, ()))
+    for user in members:
         if user is exclude:
             continue
-        if user.sock is listener:
+
+        if user.compressor is not None:
+            send_to(user, pkt, shared)
             continue
 
-        send_packet(user.sock, pkt)
+        metrics.packets_out[PacketType.CHAT.value] += 1
+        frames = frames_for(user.framing)
+        if len(frames) == 1:
+            queue_bytes(user, frames[0])
+        else:
+            queue_chunks(user, frames)
 
 
 def broadcast_user_chat(sender: User, message: str):
+    room = sender.room
+    if room is None:
+        return
     formatted = f"{sender.username}: {message}"
-    print(f"Broadcasting: {formatted}")
-    _broadcast_text(formatted, exclude=None)
+    log.debug("Broadcasting to #%s: %s", room, formatted)
+    _broadcast_text(room, formatted, exclude=None, record=True)
 
 
 def broadcast_emote(sender: User, message: str):
+    room = sender.room
+    if room is None:
+        return
     formatted = f"[{sender.username} {message}]"
-    print(f"Broadcasting emote: {formatted}")
-    _broadcast_text(formatted, exclude=None)
+    log.debug("Broadcasting emote to #%s: %s", room, formatted)
+    _broadcast_text(room, formatted, exclude=None, record=True)
+
+
+def _format_private(sender_name: str, recipient_name: str, message: str) -> str:
+    return f"{sender_name} -> {recipient_name}: {message}"
 
 
 def _send_private(sender: User, recipient: User, message: str):
-    formatted = f"{sender.username} -> {recipient.username}: {message}"
+    if sender.username is None or recipient.username is None:
+        return
+    formatted = _format_private(sender.username, recipient.username, message)
     pkt = Packet(PacketType.CHAT, formatted)
-    send_packet(recipient.sock, pkt)
-    send_packet(sender.sock, pkt)
+    send_to(recipient, pkt)
+    send_to(sender, pkt)
+
+
+def push_timer(deadline: float, callback: Callable[[Any], None], arg: Any):
+    heapq.heappush(timers, (deadline, next(_timer_seq), callback, arg))
+
+
+def call_at(deadline: float, callback: Callable[[User], None], user: User):
+    if user.transport is not None:
+        # The asyncio loop keeps its own timer heap on the same clock.
+        asyncio.get_running_loop().call_at(deadline, callback, user)
+    else:
+        push_timer(deadline, callback, user)
+
+
+def run_timers() -> float | None:
+    """
+    Runs the selectors loop's due timers and returns the seconds until the
+    next one, the timeout for the following select(), or None if there is none.
+    """
+    now = time.monotonic()
+    while timers and timers[0][0] <= now:
+        _, _, callback, user = heapq.heappop(timers)
+        callback(user)
+    return max(0.0, timers[0][0] - time.monotonic()) if timers else None
+
+
+def watch_idle(user: User):
+    if idle_timeout > 0:
+        call_at(user.last_seen + heartbeat, _check_idle, user)
+
+
+def _check_idle(user: User):
+    active = users_by_fd.get(user.fd) is user
+    # A user closing after a final write is no longer in users_by_fd, but a
+    # peer that never reads that write must not keep the socket open either.
+    if not active and not (user.closing and user.sock.fileno() != -1):
+        return
+
+    now = time.monotonic()
+    silent = now - user.last_seen
+    if silent >= idle_timeout:
+        log.info("%s was silent for %.0f s, disconnecting.", user, silent)
+        metrics.idle_disconnects += 1
+        disconnect_user(user)
+        return
+
+    if silent < heartbeat:
+        call_at(user.last_seen + heartbeat, _check_idle, user)
+        return
+
+    if active and user.ping_sent <= user.last_seen:
+        user.ping_sent = now
+        send_to(user, Packet(PacketType.PING, ""))
+    call_at(user.last_seen + idle_timeout, _check_idle, user)
 
 
 def handle_incoming_connection(listener: socket.socket):
-    new_sock, addr = listener.accept()
-    user = User(new_sock)
-    active_users.add(user)
-    print(f"New connection from {addr}. Total users: {len(active_users)}")
+    try:
+        new_sock, addr = listener.accept()
+    except BlockingIOError:
+        return
+    except OSError as e:
+        if e.errno not in ACCEPT_EXHAUSTED:
+            # The client gave up before we got to it (ECONNABORTED and such).
+            log.warning("accept() failed: %s", e)
+            return
+        log.warning("Cannot accept connections: %s.  Pausing for %.1f s, %d users connected.",
+                    e.strerror, ACCEPT_BACKOFF, len(users_by_fd))
+        selector.unregister(listener)
+        push_timer(time.monotonic() + ACCEPT_BACKOFF, _resume_accepting, listener)
+        return
+
+    new_sock.setblocking(False)
+    user = User(new_sock, chunk=recv_chunk)
+    add_user(user)
+    selector.register(new_sock, selectors.EVENT_READ, data=user)
+    watch_idle(user)
+    metrics.connections += 1
+    log.info("New connection from %s. Total users: %d", addr, len(users_by_fd))
+
+
+def _resume_accepting(listener: socket.socket):
+    selector.register(listener, selectors.EVENT_READ, data=None)
+
+
+def raise_fd_limit():
+    """
+    Raises the soft open-file limit to the hard one: every connection holds a
+    descriptor, and the usual soft limit of 1024 caps the server far below
+    what it can serve.
+    """
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # An unlimited hard limit is still capped by the kernel's nr_open.
+    wanted = hard if hard != resource.RLIM_INFINITY else 1 << 20
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, OSError) as e:
+            log.warning("Could not raise the open file limit above %d: %s", soft, e)
+    log.info("Open file limit: %d.", soft)
+
+
+def disconnect_user(user: User):
+    """
+    Unregisters the user's socket from the selector before closing it, so a
+    recycled file descriptor can be registered again on the next accept.
+    """
+    remove_user(user)
+
+    if user.transport is not None:
+        user.transport.abort()
+        return
+
+    user.outq.clear()
+    user.bulk.clear()
+    user.out_bytes = 0
+    try:
+        selector.unregister(user.sock)
+    except (KeyError, ValueError):
+        pass
+    user.sock.close()
+
+
+def close_after_flush(user: User):
+    """
+    Stops reading from the user and closes the connection once whatever is
+    already queued for them (typically an ERROR explaining why) is written.
+    """
+    if user.transport is not None:
+        remove_user(user)
+        user.transport.close()
+        return
+
+    if not user.outq:
+        disconnect_user(user)
+        return
 
+    remove_user(user)
+    user.closing = True
+    _set_write_interest(user, True)
 
-def format_user_list() -> str:
-    names: list[str] = [u.username.strip() for u in active_users if u.username]
-    unique_names: list[str] = sorted(set(names), key=str.casefold)
-    header: str = f"Total users: {len(unique_names)}\n"
-    return header + "\n".join(unique_names)
+
+def format_user_list(names: list[str] = sorted_names) -> str:
+    header: str = f"Total users: {len(names)}\n"
+    return header + "\n".join(names)
+
+
+def format_room_list(counts: list[tuple[str, int]]) -> str:
+    header: str = f"Total rooms: {len(counts)}\n"
+    return header + "\n".join(f"#{room} ({count})" for room, count in counts)
+
+
+def format_throttled_list() -> str:
+    throttled = [user for user in users_by_name.values() if user.limiter.dropped]
+    throttled.sort(key=lambda user: user.limiter.total_dropped(), reverse=True)
+
+    lines = []
+    for user in throttled:
+        counts = ", ".join(f"{type.name} {count}" for type, count in user.limiter.dropped.items())
+        lines.append(f"{user.username}: {counts}")
+
+    header: str = f"Throttled users: {len(throttled)}\n"
+    return header + "\n".join(lines)
+
+
+def _accept_hello(user: User, name: str):
+    set_username(user, name)
+    enter_room(user, DEFAULT_ROOM)
+    log.info("%s joined the chat.", user)
+
+    # The reader switched to v2 as soon as the HELLO asked for it.  Echoing
+    # the options in the (v1) answer switches our side from the next frame on.
+    accepted: list[str] = []
+    if user.reader.framing == FRAMING_V2:
+        accepted.append(FRAMING_V2_OPTION)
+        if COMPRESS_OPTION in user.reader.options and compression != "off":
+            accepted.append(COMPRESS_OPTION)
+
+    ack_pkt: Packet = Packet(PacketType.HELLO, hello_payload(f"Welcome, {user.username}!", *accepted))
+    send_to(user, ack_pkt)
+    user.framing = user.reader.framing
+    if COMPRESS_OPTION in accepted:
+        user.compressor = Compressor()
+        user.reader.accept_compressed = True
+    replay_history(user, DEFAULT_ROOM)
+
+    join_msg: str = f"*** {user.username} has joined the chat. ***"
+    _broadcast_text(DEFAULT_ROOM, join_msg, exclude=user)
+
+
+def replay_history(user: User, room: str):
+    # History is shared by everyone in the room, so compressed users get the
+    # shared-dictionary encoding, computed once per packet.
+    packets = history.packets(room)
+    if user.compressor is not None:
+        frames = [frame for pkt in packets for frame in pkt.shared_frames()]
+    else:
+        frames = [frame for pkt in packets for frame in pkt.frames(user.framing)]
+    if frames:
+        metrics.packets_out[PacketType.CHAT.value] += len(packets)
+        queue_frames(user, frames)
+
+
+def _switch_room(user: User, room: str):
+    old_room = user.room
+    if old_room is None:
+        return
+    leave_room(user)
+    _broadcast_text(old_room, f"*** {user.username} has left #{old_room}. ***")
+
+    enter_room(user, room)
+    send_to(user, Packet(PacketType.JOIN, room))
+    replay_history(user, room)
+    _broadcast_text(room, f"*** {user.username} has joined #{room}. ***", exclude=user)
+    log.info("%s moved from #%s to #%s.", user, old_room, room)
+
+
+def _reject_hello(user: User, name: str):
+    send_error_to(user, f"Username '{name}' is already taken. Please reconnect with a different name.")
+    close_after_flush(user)
+    log.info("Rejected HELLO: username '%s' taken (from %s).", name, user)
+
+
+def _throttle(user: User, type: PacketType):
+    # One ERROR per run of dropped packets; the limiter counts the rest.
+    metrics.throttled += 1
+    if user.limiter.throttled:
+        return
+
+    user.limiter.throttled = True
+    log.warning("%s is over the %s rate limit, dropping packets.", user, type.name)
+    send_error_to(user, f"Slow down: {type.name} packets are being dropped.")
 
 
 def handle_packet(user: User, pkt: Packet):
+    if not user.limiter.allow(pkt.type, time.monotonic()):
+        _throttle(user, pkt.type)
+        return
+
     match pkt.type:
         case PacketType.HELLO:
-            desired_name = pkt.payload
+            desired_name = split_hello(pkt.payload)[0].strip()
+
+            if (not desired_name or not desired_name.isprintable()
+                    or user.username is not None or user.pending_name is not None):
+                send_error_to(user, "Invalid HELLO.")
+                return
 
             existing_user = find_user_by_name(desired_name)
             if existing_user is not None:
-                send_error_to(user, f"Username '{desired_name}' is already taken. Please reconnect with a different name.")
-                try:
-                    user.sock.close()
-                finally:
-                    if user in active_users:
-                        active_users.remove(user)
-                print(f"Rejected HELLO: username '{desired_name}' taken (from {user}).")
+                _reject_hello(user, desired_name)
                 return
 
-            user.username = desired_name
-            print(f"{user} joined the chat.")
-
-            ack_pkt: Packet = Packet(PacketType.HELLO, f"Welcome, {user.username}!")
-            send_packet(user.sock, ack_pkt)
+            if bus is not None:
+                # Finished in handle_bus_message once the hub answers.
+                user.pending_name = desired_name
+                bus.send(BusType.CLAIM, str(user.fd), desired_name)
+                return
 
-            join_msg: str = f"*** {user.username} has joined the chat. ***"
-            _broadcast_text(join_msg, exclude=user)
+            _accept_hello(user, desired_name)
 
         case PacketType.GOODBYE:
-            print(f"{user} has left the chat.")
-            active_users.remove(user)
-            user.sock.close()
-            leave_msg = f"*** {user.username} has left the chat. ***"
-            _broadcast_text(leave_msg)
+            log.info("%s has left the chat.", user)
+            room = user.room
+            disconnect_user(user)
+            if room is not None:
+                leave_msg = f"*** {user.username} has left the chat. ***"
+                _broadcast_text(room, leave_msg)
+
+        case PacketType.CHAT | PacketType.EMOTE | PacketType.DM | PacketType.JOIN | PacketType.PART if user.room is None:
+            send_error_to(user, "Say HELLO before chatting.")
 
         case PacketType.CHAT:
             broadcast_user_chat(user, pkt.payload)
@@ -121,72 +784,473 @@ def handle_packet(user: User, pkt: Packet):
         case PacketType.EMOTE:
             broadcast_emote(user, pkt.payload)
 
+        case PacketType.JOIN:
+            room = normalize_room(pkt.payload)
+            if room is None:
+                send_error_to(user, f"Invalid room name: {pkt.payload}")
+            elif room == user.room:
+                send_error_to(user, f"You are already in #{room}.")
+            else:
+                _switch_room(user, room)
+
+        case PacketType.PART:
+            if user.room == DEFAULT_ROOM:
+                send_error_to(user, f"You are already in #{DEFAULT_ROOM}.")
+            else:
+                _switch_room(user, DEFAULT_ROOM)
+
+        case PacketType.LIST:
+            if bus is not None:
+                bus.send(BusType.ROOMS, str(user.fd))
+                return
+            counts = sorted((room, len(members)) for room, members in rooms.items())
+            send_to(user, Packet(PacketType.LIST, format_room_list(counts)))
+
         case PacketType.DM:
             payload = pkt.payload.strip()
             parts = payload.split(" ", 1)
+            if len(parts) < 2:
+                send_error_to(user, "usage: /dm <username> <message>")
+                return
+
             target_name, message_body = parts[0], parts[1]
             target_user = find_user_by_name(target_name)
 
+            if not target_user and bus is not None:
+                bus.send(BusType.DM, str(user.fd), user.username or "", target_name, message_body)
+                return
+
             if not target_user:
                 send_error_to(user, f"User '{target_name}' not online.")
                 return
 
-            print(f"DM from {user.username} to {target_user.username}: {message_body}")
+            log.debug("DM from %s to %s: %s", user.username, target_user.username, message_body)
             _send_private(user, target_user, message_body)
 
         case PacketType.COMMAND:
             cmd = pkt.payload
             match cmd:
                 case "users":
-                    print(f"User [{user.username}] requested /users.")
+                    log.debug("User [%s] requested /users.", user.username)
+                    if bus is not None:
+                        bus.send(BusType.USERS, str(user.fd))
+                        return
                     payload: str = format_user_list()
-                    send_packet(user.sock, Packet(PacketType.CHAT, payload))
+                    send_to(user, Packet(PacketType.CHAT, payload))
+                case "throttled":
+                    # Users of this process only, under --workers.
+                    send_to(user, Packet(PacketType.CHAT, format_throttled_list()))
                 case _:
                     send_error_to(user, f"Unknown command: {cmd}")
 
-        case PacketType.ERROR:
-            print(f"Received ERROR packet from {user}: {pkt.payload}")
+        case PacketType.PING:
+            send_to(user, Packet(PacketType.PONG, pkt.payload))
+
+        case PacketType.PONG:
+            # Reading it already refreshed user.last_seen.
             pass
 
+        case PacketType.ERROR:
+            log.info("Received ERROR packet from %s: %s", user, pkt.payload)
 
-def main(argv: list[str]):
+
+def handle_readable(user: User):
+    reader = user.reader
     try:
-        port: int = int(argv[1])
-    except:
-        print("usage: python3 chat_server.py <port>")
+        nbytes = user.sock.recv_into(reader.chunk)
+        packets = reader.feed(reader.chunk[:nbytes]) if nbytes else None
+    except BlockingIOError:
+        return
+    except OSError as e:
+        # Resets, and also ETIMEDOUT or EHOSTUNREACH from a peer that
+        # vanished: only this user is affected, never the loop.
+        log.info("%s dropped their connection (%s).", user, e.strerror or e)
+        disconnect_user(user)
+        return
+    except ValueError as e:
+        log.warning("Malformed packet from %s: %s", user, e)
+        disconnect_user(user)
+        return
+
+    if packets is None:
+        log.info("%s closed the connection.", user)
+        disconnect_user(user)
+        return
+
+    user.last_seen = time.monotonic()
+    metrics.bytes_in += nbytes
+    handle_packets(user, packets)
+
+
+def handle_packets(user: User, packets: list[Packet]):
+    packets_in = metrics.packets_in
+    timing = metrics.handle_packet
+    for pkt in packets:
+        # A packet earlier in the batch (GOODBYE, a rejected HELLO) may have
+        # closed this connection already.
+        if users_by_fd.get(user.fd) is not user:
+            break
+        packets_in[pkt.type.value] += 1
+        start = time.perf_counter_ns()
+        try:
+            handle_packet(user, pkt)
+        except UnicodeDecodeError:
+            log.warning("Malformed payload from %s, disconnecting.", user)
+            disconnect_user(user)
+            break
+        timing.observe_ns(time.perf_counter_ns() - start)
+
+
+def _bus_user(fd: str) -> User | None:
+    return users_by_fd.get(int(fd))
+
+
+def handle_bus_message(link: BusLink, type: BusType, fields: list[str]):
+    match type:
+        case BusType.CLAIMED:
+            fd, name, granted = fields
+            user = _bus_user(fd)
+            if user is None or user.pending_name != name:
+                # The connection went away while the hub was deciding.
+                if granted == "1":
+                    link.send(BusType.RELEASE, name)
+                return
+
+            user.pending_name = None
+            if granted == "1":
+                _accept_hello(user, name)
+            else:
+                _reject_hello(user, name)
+
+        case BusType.BROADCAST:
+            room, text, record = fields
+            _broadcast_local(room, text, record=record == "1")
+
+        case BusType.DELIVER:
+            sender_name, target_name, message = fields
+            target_user = find_user_by_name(target_name)
+            if target_user is not None and target_user.username is not None:
+                formatted = _format_private(sender_name, target_user.username, message)
+                send_to(target_user, Packet(PacketType.CHAT, formatted))
+
+        case BusType.DM_RESULT:
+            fd, requested_name, target_name, message = fields
+            user = _bus_user(fd)
+            if user is None or user.username is None:
+                return
+            if not target_name:
+                send_error_to(user, f"User '{requested_name}' not online.")
+                return
+            log.debug("DM from %s to %s: %s", user.username, target_name, message)
+            formatted = _format_private(user.username, target_name, message)
+            send_to(user, Packet(PacketType.CHAT, formatted))
+
+        case BusType.USERS:
+            user = _bus_user(fields[0])
+            if user is not None:
+                send_to(user, Packet(PacketType.CHAT, format_user_list(fields[1:])))
+
+        case BusType.ROOMS:
+            user = _bus_user(fields[0])
+            if user is not None:
+                listing = fields[1:]
+                counts = [(listing[i], int(listing[i+1])) for i in range(0, len(listing) - 1, 2)]
+                send_to(user, Packet(PacketType.LIST, format_room_list(counts)))
+
+
+def handle_bus_readable(link: BusLink):
+    messages = link.read()
+    if messages is None:
+        log.error("Lost connection to the hub, exiting.")
         sys.exit(1)
 
+    for type, fields in messages:
+        try:
+            handle_bus_message(link, type, fields)
+        except Exception:
+            log.exception("Bad %s message from the hub: %r", type.name, fields)
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """
+    Serves one connection from the asyncio event loop.  Framing and packet
+    handling are shared with the selector loop; only reading and writing go
+    through the transport.
+    """
+    # Set by connection_made, which asyncio calls before any other callback.
+    user: User
+    transport: asyncio.Transport
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        assert isinstance(transport, asyncio.Transport)
+        user = User(transport.get_extra_info("socket"), chunk=recv_chunk)
+        user.transport = transport
+        transport.set_write_buffer_limits(high=high_water // 2)
+        self.user = user
+        self.transport = transport
+        add_user(user)
+        watch_idle(user)
+        metrics.connections += 1
+        log.info("New connection from %s. Total users: %d", transport.get_extra_info("peername"), len(users_by_fd))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.user.reader.chunk
+
+    def buffer_updated(self, nbytes: int):
+        user = self.user
+        if users_by_fd.get(user.fd) is not user:
+            return
+
+        try:
+            packets = user.reader.feed(user.reader.chunk[:nbytes])
+        except ValueError as e:
+            log.warning("Malformed packet from %s: %s", user, e)
+            disconnect_user(user)
+            return
+
+        user.last_seen = time.monotonic()
+        metrics.bytes_in += nbytes
+        handle_packets(user, packets)
+
+    def eof_received(self) -> bool:
+        log.info("%s closed the connection.", self.user)
+        return False
+
+    def connection_lost(self, exc: Exception | None):
+        remove_user(self.user)
+
+    def pause_writing(self):
+        self.user.write_paused = True
+
+    def resume_writing(self):
+        self.user.write_paused = False
+        _pump_transport(self.user, self.transport)
+
+
+async def _sample_loop_lag(interval: float = 0.1):
+    # asyncio gives no hook around a loop iteration, so measure how late a
+    # timer fires instead: that is how long the loop was busy elsewhere.
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe_ns(max(0, int((loop.time() - expected) * 1e9)))
+
+
+async def serve_asyncio(port: int):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(ChatProtocol, port=port, reuse_address=True)
+    log.info("Chat server (asyncio) listening on port %d...", port)
+
+    if metrics_endpoint is not None:
+        await metrics_endpoint.start_asyncio()
+        # Keep a reference: the loop only holds tasks weakly.
+        lag_sampler = asyncio.create_task(_sample_loop_lag())
+
+    async with server:
+        await server.serve_forever()
+
+
+def serve_selectors(port: int, reuse_port: bool = False):
     global listener
 
     try:
         listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Every worker binds its own listener; the kernel spreads
+            # incoming connections across them.
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         listener.bind(('', port))
         listener.listen()
-        active_users.add(User(listener))
-        print(f"Chat server listening on port {port}...")
-    except socket.error:
-        print("Error creating socket.")
+        selector.register(listener, selectors.EVENT_READ, data=None)
+        log.info("Chat server listening on port %d...", port)
+        if metrics_endpoint is not None:
+            metrics_endpoint.register(selector, push_timer)
+            log.info("Metrics on http://127.0.0.1:%d/metrics", metrics_endpoint.port)
+    except socket.error as e:
+        log.error("Error creating socket: %s", e)
         sys.exit(1)
 
+    iteration = metrics.loop_iteration
     while True:
-        ready_to_read, _, _ = select.select([u.sock for u in active_users], [], [])
-        for sock in ready_to_read:
-            if sock is listener:
+        events = selector.select(run_timers())
+        start = time.perf_counter_ns()
+
+        for key, mask in events:
+            if key.data is None:
                 handle_incoming_connection(listener)
                 continue
 
-            user: User | None = find_user_by_socket(sock)
+            if isinstance(key.data, BusLink):
+                if mask & selectors.EVENT_WRITE:
+                    key.data.flush()
+                if mask & selectors.EVENT_READ:
+                    handle_bus_readable(key.data)
+                continue
 
-            if not user:
+            user: User = key.data
+            if type(user) is not User:
+                # The metrics endpoint or one of its connections.
+                key.data.handle_event(mask)
                 continue
 
-            pkt = receive_packet(user.sock, user.byte_buffer)
+            if mask & selectors.EVENT_WRITE and user.outq:
+                flush_outbound(user)
 
-            if pkt is None:
-                continue
+            if mask & selectors.EVENT_READ and users_by_fd.get(user.fd) is user:
+                handle_readable(user)
 
-            handle_packet(user, pkt)
+        iteration.observe_ns(time.perf_counter_ns() - start)
+
+
+def render_metrics() -> str:
+    queued = []
+    for user in users_by_fd.values():
+        backlog = user.out_bytes
+        if user.transport is not None:
+            backlog += user.transport.get_write_buffer_size()
+        queued.append(backlog)
+
+    gauges: dict[str, tuple[str, float]] = {
+        "chat_users_connected": ("Open client connections.", len(users_by_fd)),
+        "chat_users_named": ("Connections that completed HELLO.", len(users_by_name)),
+        "chat_rooms": ("Rooms with at least one member.", len(rooms)),
+        "chat_outbound_queued_bytes": ("Bytes queued for all users, not yet written.", sum(queued)),
+        "chat_outbound_queued_bytes_max": ("Largest per-user outbound backlog, in bytes.", max(queued, default=0)),
+        "chat_outbound_backlogged_users": ("Users with anything queued.", sum(1 for q in queued if q)),
+        "chat_history_rooms": ("Rooms holding history.", len(history.rooms)),
+        "chat_timers_pending": ("Entries in the selectors loop's timer heap.", len(timers)),
+        "chat_log_lines_suppressed": ("Log lines dropped by the log rate limit so far.",
+                                      log_filter.total_suppressed if log_filter is not None else 0),
+    }
+    return metrics.render(gauges)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="chat_server.py")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--read-size", type=int, default=DEFAULT_READ_SIZE,
+                        help="bytes requested per recv_into call")
+    parser.add_argument("--high-water", type=int, default=high_water,
+                        help="outbound bytes buffered per user, and per worker on the --workers hub, "
+                             "before --slow-policy applies")
+    parser.add_argument("--slow-policy", choices=["disconnect", "drop"], default=slow_policy,
+                        help="what to do with a user whose backlog exceeds --high-water")
+    parser.add_argument("--max-message", type=int, default=max_message,
+                        help="largest message, in bytes, a client using v2 framing may send")
+    parser.add_argument("--compression", choices=["off", "stream", "shared"], default=compression,
+                        help="deflate traffic to v2 clients that ask for it; "
+                             "'shared' compresses each broadcast once for all recipients")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve from an asyncio event loop instead of the selectors loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="fork this many selectors-loop workers sharing the port via SO_REUSEPORT")
+    parser.add_argument("--rate-limit", action="append", type=parse_limit, default=[], metavar="TYPE=RATE/BURST",
+                        help="per-user limit for one packet type, e.g. chat=5/20 or dm=off; may be repeated")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="start from no limits instead of the defaults")
+    parser.add_argument("--heartbeat", type=float, default=heartbeat,
+                        help="seconds of silence after which a user is sent a PING")
+    parser.add_argument("--idle-timeout", type=float, default=idle_timeout,
+                        help="seconds of silence after which a user is disconnected (0 disables heartbeats)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over HTTP on 127.0.0.1:PORT (worker N of --workers uses PORT+N)")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+                        help="'debug' logs every message, 'off' disables logging")
+    parser.add_argument("--log-rate", type=float, default=100.0,
+                        help="most log lines written per second; 0 for no limit")
+    parser.add_argument("--history", type=int, default=history.max_messages,
+                        help="chat lines kept per room and replayed on join (0 disables history)")
+    parser.add_argument("--history-bytes", type=int, default=history.max_bytes,
+                        help="bytes of history kept per room")
+    parser.add_argument("--history-rooms", type=int, default=history.max_rooms,
+                        help="rooms that keep history; the least recently active are evicted")
+    parser.add_argument("--history-log", metavar="PATH",
+                        help="append history to PATH and reload it from there on startup")
+    args = parser.parse_args(argv[1:])
+    if args.idle_timeout > 0 and not 0 < args.heartbeat < args.idle_timeout:
+        parser.error("--heartbeat must be positive and shorter than --idle-timeout")
+    return args
+
+
+def run_worker(index: int, bus_sock: socket.socket, args: argparse.Namespace):
+    global bus, selector, metrics_endpoint, log_filter
+    # An epoll instance inherited across fork() is shared with the parent and
+    # the other workers, so each worker needs its own.
+    selector = selectors.DefaultSelector()
+    bus = BusLink(bus_sock, selector)
+    log_filter = setup_logging(args.log_level, args.log_rate, prefix=f"[worker {index}] ")
+    log.info("Worker %d (pid %d) starting.", index, os.getpid())
+
+    if args.metrics_port is not None:
+        metrics_endpoint = MetricsEndpoint(args.metrics_port + index, render_metrics)
+
+    # Every worker sees every recorded broadcast, so one of them writing the
+    # log is enough.
+    if args.history_log and index == 0:
+        history.open_log(args.history_log)
+
+    try:
+        serve_selectors(args.port, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv: list[str]):
+    args = parse_args(argv)
+
+    global recv_chunk, high_water, slow_policy, max_message, compression, history
+    global heartbeat, idle_timeout
+    global metrics_endpoint, log_filter
+    log_filter = setup_logging(args.log_level, args.log_rate)
+    raise_fd_limit()
+    recv_chunk = bytearray(args.read_size)
+    high_water = args.high_water
+    slow_policy = args.slow_policy
+    max_message = args.max_message
+    compression = args.compression
+    heartbeat = args.heartbeat
+    idle_timeout = args.idle_timeout
+
+    # Updated in place: every User's RateLimiter refers to this dict.
+    if args.no_rate_limit:
+        rate_limits.clear()
+    for type, limit in args.rate_limit:
+        if limit is None:
+            rate_limits.pop(type, None)
+        else:
+            rate_limits[type] = limit
+    history = HistoryStore(args.history, args.history_bytes, args.history_rooms)
+
+    if args.history_log:
+        # Loaded before forking, so workers inherit it.  Rewriting drops
+        # whatever no longer fits, which keeps the file bounded too.
+        loaded = history.load_log(args.history_log)
+        history.rewrite_log(args.history_log)
+        log.info("Loaded %d history frames from %s.", loaded, args.history_log)
+
+    if args.workers > 1:
+        if args.asyncio:
+            log.error("--workers cannot be combined with --asyncio.")
+            sys.exit(1)
+        fork_workers(args.workers, lambda index, bus_sock: run_worker(index, bus_sock, args),
+                     high_water, slow_policy)
+        return
+
+    if args.history_log:
+        history.open_log(args.history_log)
+
+    if args.metrics_port is not None:
+        metrics_endpoint = MetricsEndpoint(args.metrics_port, render_metrics)
+
+    try:
+        if args.asyncio:
+            asyncio.run(serve_asyncio(args.port))
+        else:
+            serve_selectors(args.port)
+    except KeyboardInterrupt:
+        log.info("KeyboardInterrupt, stopping server...")
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,7 +1,10 @@
 from enum import Enum
 import socket
+import zlib
+import struct
+import itertools
 
-MAX_RECEIVE: int = 1028
+DEFAULT_READ_SIZE: int = 64 * 1024
 
 class PacketType(Enum):
     HELLO   = 0
@@ -12,69 +15,545 @@ class PacketType(Enum):
     COMMAND = 5
     ERROR   = 6
     ABORT   = 7
+    JOIN    = 8
+    PART    = 9
+    LIST    = 10
+    # Heartbeats: either side may PING, and the other answers PONG with the
+    # same payload.
+    PING    = 11
+    PONG    = 12
+
+# Plain dict lookup; calling PacketType(value) goes through Enum's slower path.
+_TYPE_BY_VALUE: dict[int, PacketType] = {t.value: t for t in PacketType}
+
+# Byte1 is the PacketType, Byte2-3 the payload length (unsigned, big-endian).
+HEADER: struct.Struct = struct.Struct(">BH")
+MAX_PAYLOAD: int = 0xFFFF
+
+# Framing versions.  Every connection starts on v1; a HELLO whose payload
+# carries FRAMING_V2_OPTION (see hello_payload) switches the direction it was
+# sent in to v2 for every frame after it.  The server's HELLO answer echoes
+# the option when it understood it; clients send nothing until that answer
+# and switch only if it carries the option, so an older server that stays
+# on v1 is never sent v2 frames.
+#
+# v2 frame structure:
+#     Byte1   : PacketType enum in the low 5 bits, plus flags:
+#               MORE_CHUNKS if the message continues in a later frame,
+#               STREAM_COMPRESSED or SHARED_COMPRESSED if it is deflated
+#     varint  : Message id, unique per sender and increasing
+#     varint  : Chunk length
+#     then    : Chunk bytes
+#
+# A payload larger than CHUNK_SIZE is sent as several frames with the same
+# message id, so frames of other messages can be interleaved between them.
+FRAMING_V1: int = 1
+FRAMING_V2: int = 2
+FRAMING_V2_OPTION: str = "framing=2"
+MORE_CHUNKS: int = 0x80
+TYPE_MASK: int = 0x1F
+CHUNK_SIZE: int = 16 * 1024
+# Largest v2 message a PacketReader reassembles before it gives up on the peer.
+DEFAULT_MAX_MESSAGE: int = 1024 * 1024
+
+_message_ids = itertools.count(1)
+
+# Compression, for v2 framing only.  A HELLO carrying COMPRESS_OPTION says the
+# sender's peer may deflate what it sends from then on.  The server echoes it
+# in its answer only if it agrees, and refuses compressed frames otherwise,
+# so a client deflates nothing before that answer.  Compressed payloads are
+# raw deflate with a small window, to keep per-connection state cheap
+# (about 54 KiB to compress, 15 KiB to decompress), in one of two forms:
+#
+#   STREAM_COMPRESSED : continues the sender's per-connection deflate stream
+#                       (see Compressor), sync-flushed with the trailing
+#                       00 00 FF FF left off.  Earlier messages act as the
+#                       dictionary, so repeated phrases cost a back-reference.
+#   SHARED_COMPRESSED : deflated on its own against PRESET_DICTIONARY, so the
+#                       same bytes can be sent to any number of peers.
+COMPRESS_OPTION: str = "compress=zlib"
+STREAM_COMPRESSED: int = 0x40
+SHARED_COMPRESSED: int = 0x20
+COMPRESS_LEVEL: int = 6
+COMPRESS_WBITS: int = -13
+COMPRESS_MEMLEVEL: int = 5
+# Payloads shorter than this are sent as they are.
+MIN_COMPRESS: int = 32
+# Larger payloads may end up chunked, and chunks can be overtaken by later
+# frames, so they never go through the stream; see Compressor.frames.
+STREAM_LIMIT: int = CHUNK_SIZE // 2
+# Most a stream-compressed payload can grow beyond its input.
+STREAM_SLACK: int = 16
+_SYNC_TAIL: bytes = b"\x00\x00\xff\xff"
+
+# Phrases the server sends all the time, most frequent last since deflate
+# reaches the end of the dictionary most cheaply.
+PRESET_DICTIONARY: bytes = (
+    b"Unknown command: Invalid room name: You are already in #"
+    b"usage: /dm <username> <message>Say HELLO before chatting."
+    b"Total rooms: Total users: Welcome, ! -> "
+    b" the and you that for with this have just what not but are was can will "
+    b"*** has left #lobby. ****** has joined #lobby. ***"
+    b"*** has left the chat. ****** has joined the chat. ***"
+)
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(buffer: bytes | bytearray | memoryview, offset: int) -> tuple[int, int] | None:
+    """
+    Returns the value and the offset just past it, or None if the buffer
+    ends inside the varint.
+    """
+    value = 0
+    shift = 0
+    end = len(buffer)
+
+    while offset < end:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("Varint too long")
+
+    return None
+
+
+def hello_payload(name: str, *options: str) -> str:
+    if options:
+        return name + "\n" + " ".join(options)
+    return name
+
+
+def split_hello(payload: str) -> tuple[str, list[str]]:
+    """
+    Splits a HELLO payload into the name and the options it carries, such
+    as FRAMING_V2_OPTION.
+    """
+    name, _, options = payload.partition("\n")
+    return name, options.split()
+
+
+def _deflater() -> 'zlib._Compress':
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WBITS, COMPRESS_MEMLEVEL,
+                            zdict=PRESET_DICTIONARY)
+
+
+def _inflater() -> 'zlib._Decompress':
+    return zlib.decompressobj(COMPRESS_WBITS, zdict=PRESET_DICTIONARY)
+
+
+def _v2_frames(type_byte: int, message_id: int, payload_bytes: bytes) -> list[bytes]:
+    length = len(payload_bytes)
+    message_id_bytes = encode_varint(message_id)
+    frames: list[bytes] = []
+    start = 0
+
+    while True:
+        stop = min(start + CHUNK_SIZE, length)
+        flags = MORE_CHUNKS if stop < length else 0
+        frames.append(bytes((type_byte | flags,)) + message_id_bytes + encode_varint(stop - start)
+                      + payload_bytes[start:stop])
+        if stop == length:
+            return frames
+        start = stop
 
 
 class Packet:
-    def __init__(self, type: PacketType, payload: str):
+    """
+    Packet structure:
+        Byte1   : PacketType enum
+        Byte2-3 : Payload Length, 2 byte unsigned big-endian
+        Byte4   : Payload bytes
+
+    That is the v1 framing; see FRAMING_V2 for the other.  The payload may
+    be given as str or as UTF-8 bytes and is converted to the other form
+    only when someone asks for it, so a decoded packet that is only
+    forwarded never pays for decoding.
+    """
+    __slots__ = ("type", "_payload", "_payload_bytes", "message_id", "_frames")
+
+    def __init__(self, type: PacketType, payload: str | bytes, message_id: int | None = None):
         self.type = type
-        self.payload = payload
+        # Assigned when the packet is first encoded as v2.
+        self.message_id = message_id
+        # Encoded frames by framing version, or by SHARED_COMPRESSED.
+        self._frames: dict[int, list[bytes]] | None = None
+        # At least one of the two forms is always set.
+        if isinstance(payload, str):
+            self._payload: str | None = payload
+            self._payload_bytes: bytes | None = None
+        else:
+            self._payload = None
+            self._payload_bytes = payload
 
 
-    def to_bytes(self) -> bytes:
+    @property
+    def payload(self) -> str:
+        if self._payload is None:
+            assert self._payload_bytes is not None
+            self._payload = str(self._payload_bytes, "utf-8")
+        return self._payload
+
+
+    @property
+    def payload_bytes(self) -> bytes:
+        if self._payload_bytes is None:
+            assert self._payload is not None
+            self._payload_bytes = self._payload.encode()
+        return self._payload_bytes
+
+
+    def size(self) -> int:
+        return HEADER.size + len(self.payload_bytes)
+
+
+    def pack_into(self, buffer: bytearray | memoryview, offset: int = 0) -> int:
         """
-        Packet structure:
-            Byte1   : PacketType enum
-            Byte2-3 : Payload Length, 2 byte unsigned big-endian
-            Byte4   : Payload bytes
+        Writes the frame into `buffer` at `offset` and returns its length.
         """
-        payload_bytes = self.payload.encode()
+        payload_bytes = self.payload_bytes
+        length = len(payload_bytes)
+
+        if length > MAX_PAYLOAD:
+            raise ValueError("Payload too large (max 65535 bytes)")
+
+        HEADER.pack_into(buffer, offset, self.type.value, length)
+        start = offset + HEADER.size
+        buffer[start:start+length] = payload_bytes
+        return HEADER.size + length
+
+
+    def to_bytes(self) -> bytes:
+        payload_bytes = self.payload_bytes
         length = len(payload_bytes)
 
-        if length > 0xFFFF:
+        if length > MAX_PAYLOAD:
             raise ValueError("Payload too large (max 65535 bytes)")
 
-        return bytes([self.type.value]) + length.to_bytes(2, "big") + payload_bytes
+        return HEADER.pack(self.type.value, length) + payload_bytes
+
+
+    def frames(self, framing: int = FRAMING_V1) -> list[bytes]:
+        """
+        The packet encoded for a connection using `framing`: normally one
+        frame.  A payload too large for one frame becomes several complete
+        packets under v1, or several chunks of one message under v2.  The
+        result is cached, so a broadcast is encoded once per framing version
+        rather than once per recipient.
+        """
+        if self._frames is None:
+            self._frames = {}
+
+        frames = self._frames.get(framing)
+        if frames is None:
+            frames = self._encode_v2() if framing == FRAMING_V2 else self._encode_v1()
+            self._frames[framing] = frames
+        return frames
+
+
+    def _encode_v1(self) -> list[bytes]:
+        payload_bytes = self.payload_bytes
+        length = len(payload_bytes)
+
+        if length <= MAX_PAYLOAD:
+            return [HEADER.pack(self.type.value, length) + payload_bytes]
+
+        # v1 peers decode every packet on its own, so never split inside a
+        # UTF-8 sequence.
+        frames: list[bytes] = []
+        start = 0
+        while start < length:
+            stop = min(start + MAX_PAYLOAD, length)
+            while stop < length and payload_bytes[stop] & 0xC0 == 0x80:
+                stop -= 1
+            frames.append(HEADER.pack(self.type.value, stop - start) + payload_bytes[start:stop])
+            start = stop
+        return frames
+
+
+    def _encode_v2(self) -> list[bytes]:
+        return _v2_frames(self.type.value, self.assign_id(), self.payload_bytes)
+
+
+    def assign_id(self) -> int:
+        if self.message_id is None:
+            self.message_id = next(_message_ids)
+        return self.message_id
+
+
+    def shared_frames(self) -> list[bytes]:
+        """
+        The packet as v2 frames deflated against PRESET_DICTIONARY only, so
+        one compression serves every peer that accepts compression.  Falls
+        back to plain v2 frames when deflating does not pay.  Cached like
+        frames().
+        """
+        if self._frames is None:
+            self._frames = {}
+
+        frames = self._frames.get(SHARED_COMPRESSED)
+        if frames is None:
+            payload_bytes = self.payload_bytes
+            deflated = b""
+            if len(payload_bytes) >= MIN_COMPRESS:
+                deflater = _deflater()
+                deflated = deflater.compress(payload_bytes) + deflater.flush()
+
+            if deflated and len(deflated) < len(payload_bytes):
+                frames = _v2_frames(self.type.value | SHARED_COMPRESSED, self.assign_id(), deflated)
+            else:
+                frames = self.frames(FRAMING_V2)
+            self._frames[SHARED_COMPRESSED] = frames
+        return frames
 
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> 'Packet':
-        if len(data) < 3:
-            raise ValueError("Data too short to be a valid packet")
+    def unpack_from(cls, buffer: bytes | bytearray | memoryview, offset: int = 0) -> tuple['Packet', int] | None:
+        """
+        Decodes the frame starting at `offset`.  Returns the packet and the
+        frame length, or None if the buffer does not hold the whole frame yet.
+        The payload is copied out of `buffer` but left undecoded.
+        """
+        if len(buffer) - offset < HEADER.size:
+            return None
+
+        type_byte, length = HEADER.unpack_from(buffer, offset)
+        total_length = HEADER.size + length
+
+        if len(buffer) - offset < total_length:
+            return None
+
+        packet_type = _TYPE_BY_VALUE.get(type_byte)
+        if packet_type is None:
+            raise ValueError(f"Unknown packet type {type_byte}")
 
-        type_byte = data[0]
-        length = int.from_bytes(data[1:3], 'big')
+        start = offset + HEADER.size
+        return cls(packet_type, bytes(buffer[start:start+length])), total_length
 
-        if len(data) < 3 + length:
+
+    @classmethod
+    def from_bytes(cls, data: bytes | memoryview) -> 'Packet':
+        if len(data) < HEADER.size:
+            raise ValueError("Data too short to be a valid packet")
+
+        decoded = cls.unpack_from(data)
+        if decoded is None:
             raise ValueError("Incomplete packet data")
 
-        payload_bytes = data[3:3+length]
-        payload_str = payload_bytes.decode('utf-8')
-        packet_type = PacketType(type_byte)
-        return cls(packet_type, payload_str)
+        return decoded[0]
 
 
-def send_packet(sock: socket.socket, pkt: Packet):
-    sock.sendall(pkt.to_bytes())
+class Compressor:
+    """
+    The sending half of one connection's compression: a deflate stream that
+    lives as long as the connection.  Every frame it produces has to reach
+    the peer, in order, or the peer's inflater loses track of the stream.
+    """
+    def __init__(self):
+        self.deflater = _deflater()
+        self.bytes_in = 0
+        self.bytes_out = 0
 
 
-def receive_packet(sock: socket.socket, buffer: bytearray) -> Packet | None:
-    data = sock.recv(MAX_RECEIVE)
+    def frames(self, pkt: Packet) -> list[bytes]:
+        payload_bytes = pkt.payload_bytes
+        length = len(payload_bytes)
 
-    if not data:
-        return None
+        if length < MIN_COMPRESS:
+            return pkt.frames(FRAMING_V2)
 
-    buffer.extend(data)
+        if length > STREAM_LIMIT:
+            return pkt.shared_frames()
 
-    if len(buffer) < 3:
-        return None
+        deflater = self.deflater
+        deflated = deflater.compress(payload_bytes) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        deflated = deflated[:-len(_SYNC_TAIL)]
+        self.bytes_in += length
+        self.bytes_out += len(deflated)
+        return _v2_frames(pkt.type.value | STREAM_COMPRESSED, pkt.assign_id(), deflated)
 
-    payload_length = int.from_bytes(buffer[1:3], "big")
-    total_length = 3 + payload_length
 
-    if len(buffer) < total_length:
-        return None
+def send_packet(sock: socket.socket, pkt: Packet, framing: int = FRAMING_V1,
+                compressor: Compressor | None = None):
+    frames = compressor.frames(pkt) if compressor is not None else pkt.frames(framing)
+    for frame in frames:
+        sock.sendall(frame)
+
+
+class PacketReader:
+    """
+    Streaming decoder for one connection.  Bytes are read into a preallocated
+    chunk with recv_into, appended to `buffer`, and every complete frame in
+    the buffer is decoded in one pass.  Frames are sliced out of a memoryview
+    by offset and the consumed prefix is dropped once per read rather than
+    once per frame.
+
+    The reader follows the framing negotiation by itself: it starts on v1 and
+    switches to v2 right after a HELLO that asks for it, keeping that HELLO's
+    options.  Chunked v2 messages are reassembled, up to max_message bytes in
+    flight, and compressed ones inflated, up to max_message bytes each.
+    Compressed frames are an error while accept_compressed is False, which
+    the owner sets once compression has been agreed.
+    """
+    def __init__(self, read_size: int = DEFAULT_READ_SIZE, chunk: bytearray | None = None,
+                 max_message: int = DEFAULT_MAX_MESSAGE, accept_compressed: bool = True):
+        self.buffer = bytearray()
+        self.framing = FRAMING_V1
+        self.options: list[str] = []
+        self.max_message = max_message
+        self.accept_compressed = accept_compressed
+        # message id -> (type byte, payload so far) of chunked messages still arriving.
+        self.partial: dict[int, tuple[int, bytearray]] = {}
+        self.partial_bytes = 0
+        # Created on the first STREAM_COMPRESSED frame.
+        self.inflater: 'zlib._Decompress | None' = None
+        # recv_into target.  Its contents are copied into `buffer` straight
+        # away, so a single-threaded server can share one chunk between all
+        # of its readers instead of holding read_size bytes per connection.
+        if chunk is None:
+            chunk = bytearray(read_size)
+        self.chunk = memoryview(chunk)
+
+
+    def feed(self, data: bytes | memoryview) -> list[Packet]:
+        self.buffer += data
+        return self.drain()
+
+
+    def drain(self) -> list[Packet]:
+        packets: list[Packet] = []
+        buffer = self.buffer
+        end = len(buffer)
+        offset = 0
+
+        v1 = self.framing == FRAMING_V1
+        unpack = Packet.unpack_from if v1 else self._unpack_v2
+        hello = PacketType.HELLO
 
-    packet_bytes = buffer[:total_length]
-    del buffer[:total_length]
+        with memoryview(buffer) as view:
+            while offset < end:
+                decoded = unpack(view, offset)
+
+                if decoded is None:
+                    break
+
+                pkt, total_length = decoded
+                offset += total_length
+                if pkt is None:
+                    continue
+
+                packets.append(pkt)
+                if v1 and pkt.type is hello:
+                    options = split_hello(pkt.payload)[1]
+                    if FRAMING_V2_OPTION in options:
+                        self.framing = FRAMING_V2
+                        self.options = options
+                        v1 = False
+                        unpack = self._unpack_v2
+
+        if offset:
+            del buffer[:offset]
+
+        return packets
+
+
+    def _unpack_v2(self, view: memoryview, offset: int) -> tuple[Packet | None, int] | None:
+        """
+        Decodes the v2 frame at `offset`.  Returns the packet, or None in its
+        place for a chunk that does not finish its message, and the frame
+        length; or None if the frame is not complete yet.
+        """
+        end = len(view)
+        decoded = decode_varint(view, offset + 1)
+        if decoded is None:
+            return None
+        message_id, pos = decoded
+
+        decoded = decode_varint(view, pos)
+        if decoded is None:
+            return None
+        length, start = decoded
+
+        if length > self.max_message:
+            raise ValueError(f"Frame of {length} bytes exceeds the {self.max_message} byte limit")
+        if end - start < length:
+            return None
+
+        type_byte = view[offset]
+        packet_type = _TYPE_BY_VALUE.get(type_byte & TYPE_MASK)
+        if packet_type is None:
+            raise ValueError(f"Unknown packet type {type_byte & TYPE_MASK}")
+
+        total_length = start + length - offset
+        partial = self.partial.get(message_id)
+
+        if partial is None and not type_byte & MORE_CHUNKS:
+            payload_bytes = bytes(view[start:start+length])
+            if type_byte & (STREAM_COMPRESSED | SHARED_COMPRESSED):
+                payload_bytes = self._inflate(type_byte, payload_bytes)
+            return Packet(packet_type, payload_bytes, message_id), total_length
+
+        self.partial_bytes += length
+        if self.partial_bytes > self.max_message:
+            raise ValueError(f"Chunked messages exceed the {self.max_message} byte limit")
+
+        if partial is None:
+            partial = self.partial[message_id] = (type_byte, bytearray())
+        partial[1].extend(view[start:start+length])
+
+        if type_byte & MORE_CHUNKS:
+            return None, total_length
+
+        del self.partial[message_id]
+        self.partial_bytes -= len(partial[1])
+        first_type_byte, payload = partial
+        payload_bytes = bytes(payload)
+        if first_type_byte & (STREAM_COMPRESSED | SHARED_COMPRESSED):
+            payload_bytes = self._inflate(first_type_byte, payload_bytes)
+        return Packet(_TYPE_BY_VALUE[first_type_byte & TYPE_MASK], payload_bytes, message_id), total_length
+
+
+    def _inflate(self, type_byte: int, data: bytes) -> bytes:
+        if not self.accept_compressed:
+            raise ValueError("Compressed frame, but compression was not negotiated")
+
+        if type_byte & STREAM_COMPRESSED:
+            if self.inflater is None:
+                self.inflater = _inflater()
+            inflater = self.inflater
+            data += _SYNC_TAIL
+        else:
+            inflater = _inflater()
+
+        try:
+            payload_bytes = inflater.decompress(data, self.max_message)
+        except zlib.error as e:
+            raise ValueError(f"Bad compressed payload: {e}") from None
+
+        if inflater.unconsumed_tail:
+            raise ValueError(f"Compressed payload inflates past the {self.max_message} byte limit")
+        return payload_bytes
+
+
+def receive_packets(sock: socket.socket, reader: PacketReader) -> list[Packet] | None:
+    """
+    Performs one read from `sock` and returns every frame it completed, which
+    may be an empty list.  Returns None once the peer has closed the connection.
+    """
+    nbytes = sock.recv_into(reader.chunk)
+
+    if nbytes == 0:
+        return None
 
-    return Packet.from_bytes(bytes(packet_bytes))
+    return reader.feed(reader.chunk[:nbytes])
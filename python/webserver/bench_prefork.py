@@ -0,0 +1,108 @@
+# Example usage:
+#
+# python bench_prefork.py
+# python bench_prefork.py --workers 0 1 2 4 8 --clients 16
+# python bench_prefork.py --duration 10
+#
+# Starts webserver.py once per --workers entry (0 is the single-process
+# thread pool, N > 0 the prefork mode with N processes) and has --clients
+# load generator processes fetch "/" over fresh connections for --duration
+# seconds.  Reports requests per second and the speedup over the first
+# entry.  The hello-world response makes the server's per-request Python
+# overhead the bottleneck, so with enough cores and clients the prefork
+# rows should scale close to linearly with the worker count, while the
+# thread pool stays near one core.  The load generator needs cores of its
+# own; on a small machine it becomes the limit first.
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, "webserver.py")
+REQUEST = b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+
+
+def start_server(port: int, workers: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, SERVER, str(port), str(workers)], cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait for a response rather than a connect, so every worker has had
+    # time to start listening.
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            if fetch(port):
+                time.sleep(0.5)
+                return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("webserver did not start")
+
+
+def fetch(port: int) -> bool:
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as s:
+        s.sendall(REQUEST)
+        response = b""
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                return response.startswith(b"HTTP/1.1 200")
+            response += chunk
+
+
+def client(port: int, duration: float) -> tuple[int, int]:
+    """Fetches until `duration` is up; returns (requests done, errors)."""
+    done = errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            if fetch(port):
+                done += 1
+            else:
+                errors += 1
+        except OSError:
+            errors += 1
+    return done, errors
+
+
+def main(argv: list[str]):
+    cpus = os.cpu_count() or 1
+    default_workers = sorted({0, 1} | {n for n in (2, 4, 8, 16) if n <= cpus} | {cpus})
+
+    parser = argparse.ArgumentParser(prog="bench_prefork.py")
+    parser.add_argument("--port", type=int, default=21155)
+    parser.add_argument("--workers", type=int, nargs="+", default=default_workers,
+                        help="server process counts to try; 0 is the single-process thread pool")
+    parser.add_argument("--clients", type=int, default=max(4, cpus), help="load generator processes")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per run")
+    args = parser.parse_args(argv[1:])
+
+    print(f"{'workers':>7} {'req/s':>9} {'errors':>7} {'speedup':>8}")
+    baseline = 0.0
+    with multiprocessing.Pool(args.clients) as pool:
+        for index, workers in enumerate(args.workers):
+            port = args.port + index
+            proc = start_server(port, workers)
+            try:
+                start = time.perf_counter()
+                results = pool.starmap(client, [(port, args.duration)] * args.clients)
+                elapsed = time.perf_counter() - start
+            finally:
+                proc.terminate()
+                proc.wait()
+
+            rate = sum(done for done, _ in results) / elapsed
+            errors = sum(errors for _, errors in results)
+            baseline = baseline or rate
+            print(f"{workers:7} {rate:9.0f} {errors:7} {rate / baseline:7.2f}x")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,266 @@
+"""
+Incremental HTTP/1.x request parser shared by webserver.py and
+../better-webserver/better-webserver.py.
+
+RequestParser is fed bytes as they arrive and hands back complete requests.
+It never rescans data it has already looked at: the search for the end of
+the headers resumes where the previous one stopped, and the request line
+and headers are split into a dict once, when the header block is complete.
+Bodies delimited by Content-Length or sent with chunked transfer coding
+are read in full.  Bytes after a request stay buffered for the next one,
+so pipelined requests come out in order.
+
+Limits on header block size, header count and body size are enforced while
+reading; exceeding one, or sending something unparseable, raises
+HttpParseError carrying the status code to answer with.
+"""
+import re
+import socket
+from dataclasses import dataclass
+from typing import Optional
+
+ENCODING = "ISO-8859-1"
+CRLF = b"\r\n"
+HEADER_END = b"\r\n\r\n"
+
+DEFAULT_MAX_HEADER_BYTES = 8 * 1024
+DEFAULT_MAX_HEADERS = 100
+DEFAULT_MAX_BODY = 1024 * 1024
+# Longest chunk-size or trailer line accepted.
+MAX_CHUNK_LINE = 1024
+# A chunk size is bare hex digits; int(..., 16) alone would also take a
+# sign, a 0x prefix or underscores.
+CHUNK_SIZE_RE = re.compile(rb"[0-9A-Fa-f]+")
+
+# Where a chunked body is: expecting a chunk-size line, inside a chunk's
+# data, expecting the CRLF after the data, or reading trailer fields.
+CHUNK_SIZE = 0
+CHUNK_DATA = 1
+CHUNK_DATA_END = 2
+CHUNK_TRAILERS = 3
+
+class HttpParseError(Exception):
+    def __init__(self, status: int, reason: str):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
+
+@dataclass
+class Request:
+    method: str
+    target: str
+    version: str
+    # Keys are lower-cased; repeated headers are joined with ", ".
+    headers: dict[str, str]
+    body: bytes
+    # The request line and headers as received, for logging.
+    head: str
+
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
+class RequestParser:
+    def __init__(self, max_header_bytes: int = DEFAULT_MAX_HEADER_BYTES,
+                 max_headers: int = DEFAULT_MAX_HEADERS, max_body: int = DEFAULT_MAX_BODY):
+        self.max_header_bytes = max_header_bytes
+        self.max_headers = max_headers
+        self.max_body = max_body
+        self.buf = bytearray()
+        # Where the next search of `buf` starts.
+        self.scan = 0
+        # Set once the current request's header block is parsed.
+        self.request: Optional[Request] = None
+        # Body bytes still expected: of the Content-Length, or of the
+        # current chunk.
+        self.remaining = 0
+        self.chunked = False
+        self.chunk_state = CHUNK_SIZE
+        self.trailers = 0
+        self.body = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self.buf += data
+
+    def has_buffered(self) -> bool:
+        """True if part of a request (or a whole one) is waiting in the buffer."""
+        return bool(self.buf) or self.request is not None
+
+    def next_request(self) -> Optional[Request]:
+        """
+        Returns the next complete request, or None if more data is needed.
+        """
+        if self.request is None and not self._parse_head():
+            return None
+
+        if self.chunked:
+            if not self._read_chunked():
+                return None
+        elif not self._take_body():
+            return None
+
+        request = self.request
+        request.body = bytes(self.body)
+        self.request = None
+        self.remaining = 0
+        self.chunked = False
+        self.chunk_state = CHUNK_SIZE
+        self.trailers = 0
+        self.body = bytearray()
+        self.scan = 0
+        return request
+
+    def _take_body(self) -> bool:
+        # Moves up to `remaining` bytes into the body; True once none are left.
+        take = min(self.remaining, len(self.buf))
+        if take:
+            self.body += self.buf[:take]
+            del self.buf[:take]
+            self.remaining -= take
+        return self.remaining == 0
+
+    def _parse_head(self) -> bool:
+        idx = self.buf.find(HEADER_END, self.scan)
+        if idx == -1:
+            if len(self.buf) > self.max_header_bytes:
+                raise HttpParseError(431, "Request Header Fields Too Large")
+            # The terminator may straddle this read and the next.
+            self.scan = max(0, len(self.buf) - len(HEADER_END) + 1)
+            return False
+
+        end = idx + len(HEADER_END)
+        if end > self.max_header_bytes:
+            raise HttpParseError(431, "Request Header Fields Too Large")
+
+        head = bytes(self.buf[:end]).decode(ENCODING)
+        del self.buf[:end]
+        self.scan = 0
+
+        lines = head[:-4].split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HttpParseError(400, "Bad Request")
+        method, target, version = parts
+
+        if len(lines) - 1 > self.max_headers:
+            raise HttpParseError(431, "Request Header Fields Too Large")
+
+        headers: dict[str, str] = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            # No obsolete line folding, no whitespace before the colon.
+            if not sep or not name or name != name.strip() or line[0] in " \t":
+                raise HttpParseError(400, "Bad Request")
+            key = name.lower()
+            value = value.strip()
+            headers[key] = f"{headers[key]}, {value}" if key in headers else value
+
+        self.request = Request(method=method, target=target, version=version,
+                               headers=headers, body=b"", head=head)
+        self._body_framing(headers)
+        return True
+
+    def _body_framing(self, headers: dict[str, str]) -> None:
+        transfer_encoding = headers.get("transfer-encoding")
+        content_length = headers.get("content-length")
+
+        if transfer_encoding is not None:
+            # Both at once is a request smuggling vector.
+            if content_length is not None:
+                raise HttpParseError(400, "Bad Request")
+            if transfer_encoding.split(",")[-1].strip().lower() != "chunked":
+                raise HttpParseError(501, "Not Implemented")
+            self.chunked = True
+            return
+
+        if content_length is None:
+            self.remaining = 0
+            return
+
+        if not content_length.isdigit():
+            raise HttpParseError(400, "Bad Request")
+        length = int(content_length)
+        if length > self.max_body:
+            raise HttpParseError(413, "Content Too Large")
+        self.remaining = length
+
+    def _read_chunked(self) -> bool:
+        while True:
+            if self.chunk_state == CHUNK_DATA:
+                if not self._take_body():
+                    return False
+                self.chunk_state = CHUNK_DATA_END
+                continue
+
+            line = self._read_line()
+            if line is None:
+                return False
+
+            if self.chunk_state == CHUNK_DATA_END:
+                if line:
+                    raise HttpParseError(400, "Bad Request")
+                self.chunk_state = CHUNK_SIZE
+
+            elif self.chunk_state == CHUNK_TRAILERS:
+                # Trailer fields are dropped; an empty line ends them.
+                if not line:
+                    return True
+                self.trailers += 1
+                if self.trailers > self.max_headers:
+                    raise HttpParseError(431, "Request Header Fields Too Large")
+
+            else:
+                size_text = line.split(b";", 1)[0].strip()
+                if CHUNK_SIZE_RE.fullmatch(size_text) is None:
+                    raise HttpParseError(400, "Bad Request")
+                size = int(size_text, 16)
+
+                if size == 0:
+                    self.chunk_state = CHUNK_TRAILERS
+                elif len(self.body) + size > self.max_body:
+                    raise HttpParseError(413, "Content Too Large")
+                else:
+                    self.remaining = size
+                    self.chunk_state = CHUNK_DATA
+
+    def _read_line(self) -> Optional[bytes]:
+        idx = self.buf.find(CRLF, self.scan)
+        if idx == -1:
+            if len(self.buf) > MAX_CHUNK_LINE:
+                raise HttpParseError(400, "Bad Request")
+            self.scan = max(0, len(self.buf) - 1)
+            return None
+
+        line = bytes(self.buf[:idx])
+        del self.buf[:idx + len(CRLF)]
+        self.scan = 0
+        return line
+
+def read_request(sock: socket.socket, parser: RequestParser) -> Optional[Request]:
+    """
+    Blocking helper: reads from `sock` until `parser` has a complete request.
+    Returns None if the peer closes the connection first.  Socket timeouts
+    and HttpParseError propagate.
+    """
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+
+        chunk = sock.recv(64 * 1024)
+        if not chunk:
+            return None
+        parser.feed(chunk)
+
+def error_response(error: HttpParseError) -> bytes:
+    body = f"{error.status} {error.reason.lower()}"
+    return (
+        f"HTTP/1.1 {error.status} {error.reason}\r\n"
+        "Content-Type: text/plain\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+        f"{body}"
+    ).encode(ENCODING)
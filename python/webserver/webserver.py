@@ -1,11 +1,19 @@
 import socket
 import sys
 import os
+import time
+import signal
 import threading
+import traceback
 from concurrent.futures import ThreadPoolExecutor
 
+from http_parser import RequestParser, HttpParseError, read_request, error_response
+
 iso_std: str = "ISO-8859-1"
 default_port: int = 21055
+# A worker that dies sooner than this after starting is restarted only after
+# this long, so one that cannot start does not respawn in a tight loop.
+restart_delay: float = 1.0
 
 def build_response() -> bytes:
     return (
@@ -17,59 +25,140 @@ def build_response() -> bytes:
         "Hello!"
     ).encode(iso_std)
 
-def parse_inc_header(s: socket.socket) -> tuple[bytes, bytes]:
-    buf = b""
-
-    while True:
-        chunk = s.recv(4096)
-        if not chunk:
-            return bytes(buf), b""
-        buf += chunk
-        idx = buf.find(b"\r\n\r\n")
-        if idx != -1:
-            idx += 4
-            return bytes(buf[:idx]), bytes(buf[idx:])
-
-def parse_content_length(header_bytes: bytes) -> int | None:
-    lines: list[bytes] = header_bytes.split(b"\r\n")
-    for line in lines:
-        if line.lower().startswith(b"content-length:"):
-            try:
-                return int(line.split(b" ")[1])
-            except ValueError:
-                print("Error converting Content-Length into int.")
-                return None
-
-    return None
-
-def recv_exact(s: socket.socket, length: int) -> bytes:
-    out = b""
-
-    while len(out) < length:
-        chunk = s.recv(min(4096, length - len(out)))
-        if not chunk:
-            raise ConnectionError("Connection closed before reading full body")
-        out += chunk
-
-    return bytes(out)
-
 def handle_connection(s: socket.socket):
     s.settimeout(0.2)
-    headers, prebody = parse_inc_header(s)
-    content_length = parse_content_length(headers) or 0
-
-    remaining = max(0, content_length - len(prebody))
-    body = prebody + (recv_exact(s, remaining) if remaining else b"")
-
-    request = headers + body
+    parser = RequestParser()
+    try:
+        request = read_request(s, parser)
+    except HttpParseError as e:
+        print(f"Bad request from {s}: {e}")
+        s.sendall(error_response(e))
+        s.close()
+        return
+    except socket.timeout:
+        request = None
+
+    if request is None:
+        print(f"Incomplete request from {s}")
+        s.close()
+        return
 
     print(f"Received request from {s}:")
-    print(request.decode("ISO-8859-1", errors="replace"))
+    print(request.head + request.body.decode(iso_std, errors="replace"))
 
     response = build_response()
     s.sendall(response)
     s.close()
 
+def make_listener(port: int, reuse_port: bool = False) -> socket.socket:
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds its own socket to the port and the kernel
+        # spreads incoming connections across them.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(('', port))
+    s.listen()
+    s.settimeout(1.0)
+    return s
+
+def serve(s: socket.socket, max_workers: int):
+    running: bool = True
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker") as pool:
+        try:
+            while running:
+                try:
+                    conn: tuple[socket.socket, socket._RetAddress] = s.accept()
+                except socket.timeout:
+                    continue
+
+                pool.submit(handle_connection, conn[0])
+        except KeyboardInterrupt:
+            print("Shutting down...")
+        finally:
+            pass
+
+def run_worker(index: int, port: int, listener: socket.socket | None, max_workers: int):
+    # SIGTERM from the parent lets in-flight requests finish, like Ctrl-C.
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    s = listener if listener is not None else make_listener(port, reuse_port=True)
+    print(f"worker {index} (pid {os.getpid()}) accepting with {max_workers} threads...")
+    with s:
+        serve(s, max_workers)
+
+def spawn_worker(index: int, port: int, listener: socket.socket | None, max_workers: int) -> int:
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    code = 0
+    try:
+        run_worker(index, port, listener, max_workers)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+def prefork(port: int, workers: int, max_workers: int):
+    """
+    Runs `workers` processes, each with its own accept loop and thread pool,
+    so requests are not all serialized on one GIL.  Each worker listens on
+    its own SO_REUSEPORT socket, or where that is unavailable, on one
+    listener created here and inherited.  This process only supervises:
+    a worker that exits is started again until SIGINT or SIGTERM.
+    """
+    reuse_port: bool = hasattr(socket, "SO_REUSEPORT")
+    listener: socket.socket | None = None if reuse_port else make_listener(port)
+    threads: int = max(1, max_workers // workers)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    # pid -> (worker index, start time)
+    children: dict[int, tuple[int, float]] = {}
+    for index in range(workers):
+        children[spawn_worker(index, port, listener, threads)] = (index, time.monotonic())
+
+    mode: str = "SO_REUSEPORT sockets" if reuse_port else "a shared listener"
+    print(f"webserver listening on port {port} with {workers} processes on {mode}...")
+
+    try:
+        while True:
+            pid, status = os.wait()
+            index, started = children.pop(pid)
+            code = os.waitstatus_to_exitcode(status)
+            reason = f"signal {-code}" if code < 0 else f"exit code {code}"
+            print(f"worker {index} (pid {pid}) died with {reason}; restarting.")
+
+            if time.monotonic() - started < restart_delay:
+                time.sleep(restart_delay)
+            children[spawn_worker(index, port, listener, threads)] = (index, time.monotonic())
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+        # A second signal must not interrupt reaping the workers below.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        if listener is not None:
+            listener.close()
+
 def main(argc: int, argv: list[str]):
     target_port: int = default_port 
 
@@ -79,31 +168,23 @@ def main(argc: int, argv: list[str]):
         except ValueError:
             print("<target_port> could not be converted to a port number; invalid format.  Using default port.")
 
-    max_workers: int = (os.cpu_count() or 4) * 4
+    workers: int = 0
 
-    with socket.socket() as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('', target_port))
-        s.listen()
-        s.settimeout(1.0)
+    if argc > 2:
+        try:
+            workers = int(argv[2])
+        except ValueError:
+            print("<workers> could not be converted to a number; invalid format.  Using one process.")
 
-        print(f"webserver listening on port {target_port} with {max_workers} workers...")
+    max_workers: int = (os.cpu_count() or 4) * 4
 
-        running: bool = True
+    if workers > 0:
+        prefork(target_port, workers, max_workers)
+        return
 
-        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker") as pool:
-            try:
-                while running:
-                    try:
-                        conn: tuple[socket.socket, socket._RetAddress] = s.accept()
-                    except socket.timeout:
-                        continue
-
-                    pool.submit(handle_connection, conn[0])
-            except KeyboardInterrupt:
-                print("Shutting down...")
-            finally:
-                pass
+    with make_listener(target_port) as s:
+        print(f"webserver listening on port {target_port} with {max_workers} workers...")
+        serve(s, max_workers)
 
 
 if __name__ == "__main__":